@@ -0,0 +1,204 @@
+"""
+A background job queue backed by the db_background_job table
+
+Web requests enqueue long running work and return immediately. The `flask worker` processes claim the queued jobs and
+run them, which requires nothing but the database, so it works the same against SQLite and Postgres.
+
+A running job holds a lease which its worker renews every third of MOROCCO_BACKGROUND_JOB_LEASE seconds. The job of a
+worker which crashed or lost the database stops being renewed, and is claimed again by another worker once its lease
+expired.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Union
+
+from morocco.util import get_logger
+
+DEFAULT_JOB_LEASE = 600  # in seconds
+
+_handlers = {}  # pylint: disable=invalid-name
+
+
+def job_handler(kind: str) -> Callable:
+    """Register the decorated function as the handler of the given kind of background job."""
+
+    def _decorator(func: Callable) -> Callable:
+        _handlers[kind] = func
+        return func
+
+    return _decorator
+
+
+class JobProgress(object):  # pylint: disable=too-few-public-methods
+    def __init__(self, job):
+        self._job = job
+
+    def report(self, progress: int, total: int = None, message: str = None) -> None:
+        from morocco.application import db
+
+        self._job.progress = progress
+        self._job.heartbeat_time = datetime.utcnow()
+        if total is not None:
+            self._job.total = total
+        if message is not None:
+            self._job.message = message
+        db.session.commit()
+
+
+def enqueue(kind: str, **payload):
+    """
+    Queue a background job. The URL root of the current request is saved with the payload so that the handler can
+    build external URLs, e.g. the callback URLs of the batch jobs.
+    """
+    from flask import request
+    from morocco.application import db
+    from morocco.models import DbBackgroundJob
+
+    if kind not in _handlers:
+        raise ValueError('Unknown background job {}'.format(kind))
+
+    payload['base_url'] = request.url_root
+    job = DbBackgroundJob(kind, json.dumps(payload))
+    db.session.add(job)
+    db.session.commit()
+
+    return job
+
+
+def claim_job(worker_id: str):
+    """
+    Claim the oldest queued job, or a running job whose lease expired. The conditional update makes sure only one
+    worker wins a job.
+    """
+    from sqlalchemy import and_, or_
+    from morocco.application import db
+    from morocco.core.services import get_setting
+    from morocco.models import DbBackgroundJob
+
+    expired = datetime.utcnow() - timedelta(seconds=int(get_setting('background_job_lease', DEFAULT_JOB_LEASE)))
+    while True:
+        job = DbBackgroundJob.query.filter(or_(DbBackgroundJob.state == 'queued',
+                                               and_(DbBackgroundJob.state == 'running',
+                                                    DbBackgroundJob.heartbeat_time < expired))) \
+            .order_by(DbBackgroundJob.id) \
+            .first()
+        if not job:
+            return None
+
+        if job.state == 'running':
+            get_logger('background').warning('Reclaim background job %s of worker %s, its lease expired at %s', job.id,
+                                             job.worker, job.heartbeat_time)
+
+        now = datetime.utcnow()
+        claimed = DbBackgroundJob.query.filter_by(id=job.id, state=job.state, heartbeat_time=job.heartbeat_time) \
+            .update({DbBackgroundJob.state: 'running',
+                     DbBackgroundJob.worker: worker_id,
+                     DbBackgroundJob.start_time: now,
+                     DbBackgroundJob.heartbeat_time: now}, synchronize_session=False)
+        db.session.commit()
+
+        if claimed:
+            db.session.refresh(job)
+            return job
+
+
+def run_job(job) -> None:
+    from morocco.application import app, db
+
+    logger = get_logger('background')
+    payload = json.loads(job.payload or '{}')
+    base_url = payload.pop('base_url', None)
+
+    logger.info('Run background job %s', job)
+    stopped = threading.Event()
+    threading.Thread(target=_renew_lease, args=(job.id, job.worker, stopped), name='background-job-lease',
+                     daemon=True).start()
+    try:
+        with app.test_request_context('/', base_url=base_url):
+            message = _handlers[job.kind](JobProgress(job), **payload)
+        job.state = 'succeeded'
+        job.message = message or job.message
+    except Exception as ex:  # pylint: disable=broad-except
+        logger.exception('Background job %s failed', job.id)
+        db.session.rollback()
+        job.state = 'failed'
+        job.message = str(ex)
+    finally:
+        stopped.set()
+
+    job.end_time = datetime.utcnow()
+    db.session.commit()
+
+
+def _renew_lease(job_id: int, worker_id: str, stopped: threading.Event) -> None:
+    """Renew the lease of the job on a connection of its own, as long as the worker still owns the job."""
+    from morocco.application import db
+    from morocco.core.services import get_setting
+    from morocco.models import DbBackgroundJob
+
+    table = DbBackgroundJob.__table__
+    interval = int(get_setting('background_job_lease', DEFAULT_JOB_LEASE)) / 3
+    while not stopped.wait(interval):
+        try:
+            db.engine.execute(table.update()
+                              .where(table.c.id == job_id)
+                              .where(table.c.worker == worker_id)
+                              .where(table.c.state == 'running')
+                              .values(heartbeat_time=datetime.utcnow()))
+        except Exception:  # pylint: disable=broad-except
+            get_logger('background').exception('Fail to renew the lease of background job %s', job_id)
+
+
+def run_worker(poll_interval: float = 5.0, max_jobs: Union[int, None] = None) -> None:
+    """Run the queued jobs one at a time, polling the queue when it is empty."""
+    from morocco.eventlog import get_event_log
+
+    worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+    logger = get_logger('background')
+    logger.info('Worker %s started', worker_id)
+
+    count = 0
+    while max_jobs is None or count < max_jobs:
+        job = claim_job(worker_id)
+        if not job:
+            # replay the segments which failed to flush and the logs of crashed web workers while there is nothing else
+            # to do, the live web workers rotate their own logs
+            get_event_log().flush()
+            time.sleep(poll_interval)
+            continue
+
+        run_job(job)
+        count += 1
+
+
+@job_handler('sync_builds')
+def _sync_builds(progress: JobProgress) -> str:
+    from morocco.core import get_source_control_commits, sync_builds
+    from morocco.models import DbBuild
+
+    # sync every commit since the last build, or the latest page of commits if nothing was built yet
+    last_build = DbBuild.query.filter(DbBuild.commit_date.isnot(None)).order_by(DbBuild.commit_date.desc()).first()
+    if last_build:
+        # the since filter is inclusive so the last build shows up again
+        commits = [c for c in get_source_control_commits(since=last_build.commit_date.strftime('%Y-%m-%dT%H:%M:%SZ'))
+                   if c['sha'] != last_build.id]
+    else:
+        commits = get_source_control_commits(max_pages=1)
+
+    progress.report(0, len(commits))
+    sync_builds(commits, create_job=True, progress=lambda done, total: progress.report(done, total))
+
+    return 'Synced {} builds'.format(len(commits))
+
+
+@job_handler('refresh_test')
+def _refresh_test(progress: JobProgress, job_id: str) -> str:
+    from morocco.core import refresh_test_run
+
+    refresh_test_run(job_id, lambda done, total: progress.report(done, total))
+    return 'Refreshed test run {}'.format(job_id)
@@ -1,4 +1,4 @@
 # pylint: disable=unused-import
 
-from morocco.batch.actions import create_build_job, create_test_job, get_job, list_tasks
-from morocco.batch.util import get_metadata
+from morocco.batch.actions import create_build_job, create_test_job, get_job, list_tasks, list_task_records
+from morocco.batch.util import get_metadata, TaskRecord, ExecutionRecord
@@ -1,20 +1,25 @@
 import os
 import base64
-from typing import Iterable
+import hashlib
+from typing import Iterable, Iterator, List
 from datetime import datetime, timedelta
 
 from flask import url_for
 
-from azure.batch.models import (TaskAddParameter, JobAddParameter, JobPreparationTask, JobManagerTask, PoolInformation,
-                                OutputFile, OutputFileDestination, OutputFileUploadOptions, OutputFileUploadCondition,
-                                OutputFileBlobContainerDestination, OnAllTasksComplete, EnvironmentSetting,
-                                ResourceFile, MetadataItem, CloudJob, CloudTask, TaskDependencies)
+from azure.batch.models import (TaskAddParameter, JobAddParameter, JobPreparationTask, JobReleaseTask, JobManagerTask,
+                                PoolInformation, OutputFile, OutputFileDestination, OutputFileUploadOptions,
+                                OutputFileUploadCondition, OutputFileBlobContainerDestination, OnAllTasksComplete,
+                                EnvironmentSetting, MetadataItem, CloudJob, CloudTask, TaskDependencies, TaskAddStatus,
+                                ResourceFile)
 from azure.storage.blob import ContainerPermissions
 
 from morocco.core import (get_batch_client, get_source_control_info, get_batch_pool, get_blob_storage_client,
-                          get_automation_actor_info, get_batch_account_info)
+                          get_automation_actor_info, get_batch_account_info, get_container_sas, get_setting)
+from morocco.batch.util import TaskRecord
 from morocco.util import get_command_string, get_logger
 
+DEFAULT_TEST_CACHE_BUDGET_MB = 20 * 1024
+
 
 def _get_build_blob_container_url() -> str:
     storage_client = get_blob_storage_client()
@@ -23,15 +28,36 @@ def _get_build_blob_container_url() -> str:
         container_name='builds',
         blob_name='',
         protocol='https',
-        sas_token=storage_client.generate_container_shared_access_signature(
-            container_name='builds',
-            permission=ContainerPermissions(list=True, write=True),
-            expiry=(datetime.utcnow() + timedelta(days=1))))
+        sas_token=get_container_sas('builds', ContainerPermissions(list=True, write=True), timedelta(days=1)))
+
+
+def _get_git_mirror_clone_commands(url: str, target: str) -> List[str]:
+    """
+    The commands which clone the repository from a bare mirror of its branches kept in the shared directory of the node.
+
+    The first build on a node creates the mirror, the later ones fetch only the new commits of the branches into it, not
+    the refs of the pull requests, and clone it with --shared, which borrows its objects instead of copying them. A
+    fetch only adds objects and the mirror never prunes them, so it runs next to the clones of the running builds, one
+    fetch at a time. Every build holds a shared lock on the mirror until it exits, since its clone borrows the objects
+    for as long as it runs. A mirror which fails to fetch is removed and created again under the exclusive lock, so only
+    that waits for the running builds.
+    """
+    mirror = '$AZ_BATCH_NODE_SHARED_DIR/git-heads'
+    refspec = '+refs/heads/\\*:refs/heads/\\*'  # the * are escaped from the shell, files could match them
+    fetch = 'flock {0}.fetch.lock git -C {0} fetch -q --prune {1} {2}'.format(mirror, url, refspec)
+    create = 'flock {0}.fetch.lock flock {0}.lock -c "rm -rf {0} && git init -q --bare {0} && ' \
+             'git -C {0} config gc.pruneExpire never && git -C {0} fetch -q {1} {2}"'.format(mirror, url, refspec)
+
+    return ['({}) || ({})'.format(fetch, create),
+            'exec 9>{}.lock'.format(mirror),
+            'flock -s 9',
+            'git clone -q --shared --no-checkout {} {}'.format(mirror, target)]
 
 
-def create_build_job(commit_sha: str) -> CloudJob:
+def create_build_job(commit_sha: str, callback_url: str = None) -> CloudJob:
     """
-    Schedule a build job in the given pool. returns the container for build output and job reference.
+    Schedule a build job in the given pool. returns the container for build output and job reference. The URL of the
+    build.finished callback defaults to the post_api_build view of the current request.
 
     Building and running tests are two separate builds so that the testing job can relies on job preparation tasks to
     prepare test environment. The product and test build is an essential part of the preparation. The builds can't be
@@ -67,8 +93,7 @@ def create_build_job(commit_sha: str) -> CloudJob:
     logger.info('Job %s is created.', commit_sha)
 
     output_file_name = 'azure-cli-{}.tar'.format(commit_sha)
-    build_commands = [
-        'git clone --depth=50 {} {}'.format(source_control_info.url, remote_source_dir),
+    build_commands = _get_git_mirror_clone_commands(source_control_info.url, remote_source_dir) + [
         'pushd {}'.format(remote_source_dir),
         'git checkout -qf {}'.format(commit_sha),
         './scripts/batch/build_all.sh',
@@ -88,21 +113,86 @@ def create_build_job(commit_sha: str) -> CloudJob:
                                   output_files=[output_file])
 
     cburl = 'curl -X post {} -H "X-Batch-Event: build.finished" --data-urlencode secret={} --data-urlencode sha={}'
-    report_cmd = cburl.format(url_for('post_api_build', _external=True, _scheme='https'), secret, commit_sha)
+    report_cmd = cburl.format(callback_url or url_for('post_api_build', _external=True, _scheme='https'), secret,
+                              commit_sha)
 
     report_task = TaskAddParameter(id='report',
                                    command_line=get_command_string(report_cmd),
                                    depends_on=TaskDependencies(task_ids=[build_task.id]),
                                    display_name='Request service to pull result')
 
-    batch_client.task.add(commit_sha, build_task)
-    batch_client.task.add(commit_sha, report_task)
+    result = batch_client.task.add_collection(commit_sha, [build_task, report_task])
+    failed = [r.task_id for r in result.value if r.status != TaskAddStatus.success]
+    if failed:
+        raise ValueError('Fail to add tasks {} to job {}.'.format(', '.join(failed), commit_sha))
     logger.info('Build task is added to job %s', commit_sha)
 
     return batch_client.job.get(commit_sha)
 
 
-def create_test_job(build_id: str, run_live: bool = False) -> str:  # pylint: disable=too-many-locals
+_ARTIFACT_CACHE = '$AZ_BATCH_NODE_SHARED_DIR/artifact-cache'
+# a pin older than this, e.g. of a job whose release task never ran, no longer keeps its entry from eviction
+_ARTIFACT_PIN_MAX_AGE = 7 * 24 * 60  # in minutes
+
+
+def _get_artifact_cache_commands() -> List[str]:
+    """
+    The commands of the job preparation task, which prepare the build and the app from a cache on the test node.
+
+    The cache keeps the extracted build and app of every ARTIFACT_KEY in the shared directory of the node, and copies
+    them into the working directory of the task. They're downloaded and extracted on a cache miss only. The entry is
+    pinned by the job until its release task runs, and the least recently used entries which no job pins are evicted
+    until the cache fits in ARTIFACT_CACHE_BUDGET_MB. The cache is locked so the jobs on the same node fill and evict
+    it one at a time.
+
+    install.sh still runs in the working directory of every job, as it did before the cache: what it changes on the
+    node is up to the app, so it can't be assumed to hold for another job. For the same reason the entry is copied
+    rather than linked, hard links included, so install.sh never writes into the tree another job of the same build
+    uses. The pin keeps the entry from being evicted while it is copied outside of the lock.
+    """
+    cache, pins = _ARTIFACT_CACHE, '{}.pins'.format(_ARTIFACT_CACHE)
+    entry = '{}/$ARTIFACT_KEY'.format(cache)
+
+    download = ['rm -rf {0}', 'mkdir -p {0}',
+                'curl -sSfL -o {0}/$BUILD_FILE "$BUILD_URL"',
+                'curl -sSfL -o {0}/tangier.tar "$APP_URL"',
+                '(cd {0} && tar xf $BUILD_FILE && mv ./artifacts/* ./ && tar xf tangier.tar)',
+                'rm -f {0}/$BUILD_FILE {0}/tangier.tar',
+                'touch {0}/.complete']
+    evict = ['[ $(du -sm {0} | cut -f1) -le $ARTIFACT_CACHE_BUDGET_MB ] && break',
+             '[ -n "$(find {1}/$each -type f -mmin -{2} 2>/dev/null)" ] && continue',
+             'rm -rf {0}/$each {1}/$each']
+
+    return ['mkdir -p {} {}'.format(cache, pins),
+            'exec 9>{}.lock'.format(cache),
+            'flock 9',
+            'if [ ! -f {0}/.complete ]; then {1}; fi'.format(entry, '; '.join(download).format(entry)),
+            'touch {}'.format(entry),
+            'mkdir -p {0}/$ARTIFACT_KEY && touch {0}/$ARTIFACT_KEY/$AZ_BATCH_JOB_ID'.format(pins),
+            'for each in $(ls -1tr {}); do {}; done'.format(cache, '; '.join(evict).format(cache, pins,
+                                                                                        _ARTIFACT_PIN_MAX_AGE)),
+            'exec 9>&-',
+            'cp -a {}/* ./'.format(entry),
+            './app/install.sh']
+
+
+def _get_artifact_release_commands() -> List[str]:
+    """The commands of the job release task, which unpin the cache entry of the job."""
+    return ['exec 9>{}.lock'.format(_ARTIFACT_CACHE),
+            'flock 9',
+            'rm -f {}.pins/$ARTIFACT_KEY/$AZ_BATCH_JOB_ID'.format(_ARTIFACT_CACHE)]
+
+
+def create_test_job(build_id: str, run_live: bool = False,  # pylint: disable=too-many-locals
+                    shard_count: int = None, selective: bool = None) -> str:
+    """
+    Create the test job of the build. The tests are run in shard_count tasks, which defaults to
+    MOROCCO_TEST_SHARD_COUNT, packed by their historical durations, or in one task per test if it is 0. If selective,
+    which defaults to MOROCCO_TEST_SELECTION, only the tests of the modules the build changed are run.
+    """
+    from morocco.core.selection import select_test_modules
+    from morocco.core.sharding import create_test_schedule, DEFAULT_TEST_SHARD_COUNT, SCHEDULE_FILE
+
     logger = get_logger('test')
 
     batch_account = get_batch_account_info()
@@ -112,21 +202,21 @@ def create_test_job(build_id: str, run_live: bool = False) -> str:  # pylint: di
     job_id = 'test-{}'.format(datetime.utcnow().strftime('%Y%m%d-%H%M%S'))
     output_file_name = 'azure-cli-{}.tar'.format(build_id)
 
-    def _list_build_resource_files() -> Iterable[ResourceFile]:
-        """ List the files belongs to the target build in the build blob container """
+    def _get_artifact_environment() -> List[EnvironmentSetting]:
+        """ The download URLs of the build and the app, and the key they're cached by on the test nodes """
         permission = ContainerPermissions(read=True)
-        expiry = (datetime.utcnow() + timedelta(days=1))
-        build_sas = storage_client.generate_container_shared_access_signature(container_name='builds',
-                                                                              permission=permission,
-                                                                              expiry=expiry)
-        app_sas = storage_client.generate_container_shared_access_signature(container_name='app',
-                                                                            permission=permission,
-                                                                            expiry=expiry)
-
-        return [ResourceFile(blob_source=storage_client.make_blob_url('builds', output_file_name, 'https', build_sas),
-                             file_path=output_file_name),
-                ResourceFile(blob_source=storage_client.make_blob_url('app', 'tangier.tar', 'https', app_sas),
-                             file_path='tangier.tar')]
+        build_sas = get_container_sas('builds', permission, timedelta(days=1))
+        app_sas = get_container_sas('app', permission, timedelta(days=1))
+        app_etag = storage_client.get_blob_properties('app', 'tangier.tar').properties.etag
+
+        return [EnvironmentSetting('ARTIFACT_KEY', '{}-{}'.format(
+            build_id, hashlib.sha1(app_etag.encode('utf-8')).hexdigest()[:12])),
+                EnvironmentSetting('ARTIFACT_CACHE_BUDGET_MB', str(get_setting('test_cache_budget_mb',
+                                                                               DEFAULT_TEST_CACHE_BUDGET_MB))),
+                EnvironmentSetting('BUILD_FILE', output_file_name),
+                EnvironmentSetting('BUILD_URL', storage_client.make_blob_url('builds', output_file_name, 'https',
+                                                                             build_sas)),
+                EnvironmentSetting('APP_URL', storage_client.make_blob_url('app', 'tangier.tar', 'https', app_sas))]
 
     def _create_output_container_folder() -> str:
         """ Create output storage container """
@@ -137,34 +227,40 @@ def create_test_job(build_id: str, run_live: bool = False) -> str:  # pylint: di
             container_name='output',
             blob_name='',
             protocol='https',
-            sas_token=storage_client.generate_container_shared_access_signature(
-                container_name='output',
-                permission=ContainerPermissions(list=True, write=True),
-                expiry=(datetime.utcnow() + timedelta(days=1))))
+            sas_token=get_container_sas('output', ContainerPermissions(list=True, write=True), timedelta(days=1)))
 
     # create automation job
-    resource_files = _list_build_resource_files()
-    if not resource_files:
+    if not storage_client.exists('builds', output_file_name):
         logger.error('The build %s is not found in the builds container', build_id)
         raise ValueError('Fail to find build {}'.format(build_id))
 
-    prep_task = JobPreparationTask(get_command_string('tar xvf {}'.format(output_file_name),
-                                                      'mv ./artifacts/* ./',
-                                                      'tar xvf tangier.tar',
-                                                      './app/install.sh'),
-                                   resource_files=resource_files,
+    artifact_environment = _get_artifact_environment()
+    prep_task = JobPreparationTask(get_command_string(*_get_artifact_cache_commands()),
+                                   environment_settings=artifact_environment,
                                    wait_for_success=True)
+    release_task = JobReleaseTask(get_command_string(*_get_artifact_release_commands()),
+                                  environment_settings=[e for e in artifact_environment if e.name == 'ARTIFACT_KEY'])
 
     env_settings = [EnvironmentSetting(name='AZURE_BATCH_KEY', value=batch_account.key),
                     EnvironmentSetting(name='AZURE_BATCH_ENDPOINT', value=batch_account.endpoint)]
 
+    output_container_url = _create_output_container_folder()
+
+    if shard_count is None:
+        shard_count = int(get_setting('test_shard_count', DEFAULT_TEST_SHARD_COUNT))
+    if selective is None:
+        selective = str(get_setting('test_selection', 'false')).lower() == 'true'
+    modules = select_test_modules(build_id) if selective else None
+    schedule_url = create_test_schedule(job_id, shard_count, modules)
+    if schedule_url:
+        env_settings.append(EnvironmentSetting(name='AUTOMATION_TEST_SCHEDULE', value=SCHEDULE_FILE))
+
     manage_task = JobManagerTask('test-creator',
                                  get_command_string('$AZ_BATCH_NODE_SHARED_DIR/app/schedule.sh'),
                                  'Automation tasks creator',
                                  kill_job_on_completion=False,
-                                 environment_settings=env_settings)
-
-    output_container_url = _create_output_container_folder()
+                                 environment_settings=env_settings,
+                                 resource_files=[ResourceFile(schedule_url, SCHEDULE_FILE)] if schedule_url else None)
 
     cburl = 'curl -X post {} -H "X-Batch-Event: test.finished" --data-urlencode job_id={}'
     report_cmd = cburl.format(url_for('api_hook', _external=True, _scheme='https'), job_id)
@@ -187,6 +283,8 @@ def create_test_job(build_id: str, run_live: bool = False) -> str:  # pylint: di
                     MetadataItem('secret', secret),
                     MetadataItem('build', build_id),
                     MetadataItem('live', str(run_live))]
+    if modules is not None:
+        job_metadata.append(MetadataItem('modules', ','.join(sorted(modules))))
 
     # create automation job
     batch_client.job.add(JobAddParameter(
@@ -195,6 +293,7 @@ def create_test_job(build_id: str, run_live: bool = False) -> str:  # pylint: di
         display_name='Automation on build {}. Live: {}'.format(build_id, run_live),
         common_environment_settings=job_environment,
         job_preparation_task=prep_task,
+        job_release_task=release_task,
         job_manager_task=manage_task,
         on_all_tasks_complete=OnAllTasksComplete.terminate_job,
         metadata=job_metadata,
@@ -208,5 +307,24 @@ def get_job(job_id: str) -> CloudJob:
     return get_batch_client().job.get(job_id)
 
 
-def list_tasks(job_id: str) -> Iterable[CloudTask]:
-    return get_batch_client().task.list(job_id)
+def list_tasks(job_id: str, select: str = None, task_filter: str = None) -> Iterable[CloudTask]:
+    """List the tasks of the job, optionally with OData $select and $filter clauses. The pages are fetched lazily."""
+    from azure.batch.models import TaskListOptions
+    return get_batch_client().task.list(job_id, TaskListOptions(filter=task_filter, select=select))
+
+
+def list_task_records(job_id: str, completed_only: bool = True,
+                      completed_since: datetime = None) -> Iterator[TaskRecord]:
+    """
+    List the tasks of the job as lightweight records, selecting only the properties a test case is created from. The
+    tasks can be limited to the completed ones, and to the ones completed after the given time.
+    """
+    clauses = []
+    if completed_only or completed_since:
+        clauses.append("state eq 'completed'")
+    if completed_since:
+        clauses.append("executionInfo/endTime gt DateTime'{}'".format(completed_since.strftime('%Y-%m-%dT%H:%M:%SZ')))
+
+    for task in list_tasks(job_id, select='id,displayName,state,executionInfo',
+                           task_filter=' and '.join(clauses) or None):
+        yield TaskRecord(task.id, task.display_name, task.state, task.execution_info)
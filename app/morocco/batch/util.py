@@ -1,6 +1,12 @@
+from collections import namedtuple
 from typing import List, Union
 from azure.batch.models import MetadataItem
 
+# the properties of a task needed to record a test case, see list_task_records
+TaskRecord = namedtuple('TaskRecord', ['id', 'display_name', 'state', 'execution_info'])
+# the execution information of a test run in a shard task, see morocco.core.sharding
+ExecutionRecord = namedtuple('ExecutionRecord', ['start_time', 'end_time', 'exit_code'])
+
 
 def get_metadata(metadata: List[MetadataItem], name: str) -> Union[str, None]:
     for each in metadata or []:
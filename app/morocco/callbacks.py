@@ -0,0 +1,165 @@
+"""
+An asyncio server of the batch callbacks, /api/hook and /api/build
+
+A large test job sends thousands of test.finished callbacks within seconds. Served by uwsgi, each of them holds a worker
+while it waits on Batch, Blob storage and the database. This server, started with `flask callbacks`, handles them on an
+event loop: the test output is downloaded with aiohttp, and the calls of the synchronous Batch SDK and the database
+writes are run on a bounded thread pool of MOROCCO_CALLBACK_CONCURRENCY threads, at most as many as the database
+connection pool holds. The test cases and builds are recorded by the same code as the Flask views, so the results are
+identical.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web, ClientSession
+
+from morocco.util import get_logger
+
+DEFAULT_CALLBACK_CONCURRENCY = 32
+
+
+def create_callback_app() -> web.Application:
+    from morocco.core.services import get_setting
+
+    concurrency = int(get_setting('callback_concurrency', DEFAULT_CALLBACK_CONCURRENCY))
+
+    callback_app = web.Application()
+    # every thread holds a database connection, more threads than the connection pool has would time out waiting
+    callback_app['executor'] = ThreadPoolExecutor(max_workers=min(concurrency, _get_db_pool_capacity()))
+    callback_app['downloads'] = asyncio.Semaphore(concurrency)
+    callback_app.router.add_post('/api/hook', api_hook)
+    callback_app.router.add_post('/api/build', post_api_build)
+    callback_app.on_startup.append(_start_http_session)
+    callback_app.on_cleanup.append(_close_http_session)
+
+    return callback_app
+
+
+async def api_hook(request: web.Request) -> web.Response:
+    from morocco.core.sharding import is_shard_task
+
+    if request.headers.get('X-Batch-Event') != 'test.finished':
+        return web.Response(text='Unknown event', status=400)
+
+    body = await request.read()
+    form = await request.post()
+    job_id, task_id = form.get('job_id'), form.get('task_id')
+
+    await _run(request, _append_event, 'batch', body.decode('utf-8'))
+    task, job = await asyncio.gather(_run(request, _get_task, job_id, task_id), _run(request, _get_job, job_id))
+
+    outputs = {}
+    if task.execution_info.exit_code != 0 and not is_shard_task(task):
+        # only load output of failed tests for performance reason. the outputs of a shard are in its results.
+        url = await _run(request, _get_test_output_url, job_id, task_id)
+        async with request.app['downloads']:
+            outputs[task.id] = await _fetch_test_output(request.app['http'], url)
+
+    await _run(request, _save_test_case, job_id, job.state.value, task, outputs)
+
+    return web.Response(text='Update {} {}'.format(job_id, task_id))
+
+
+async def post_api_build(request: web.Request) -> web.Response:
+    """Dispatch the callback to the Flask view, which only waits on Batch and the database, on the thread pool."""
+    body = await request.read()
+    status, headers, content = await _run(request, _dispatch_flask_request, request.method, request.path_qs,
+                                          dict(request.headers), body)
+
+    return web.Response(body=content, status=status,
+                        headers={'Content-Type': headers.get('Content-Type', 'text/html; charset=utf-8')})
+
+
+async def _fetch_test_output(session: ClientSession, url: str) -> str:
+    from morocco.core.ingestion import (TestOutputExtractor, is_test_output_too_large, get_test_output_tail_range,
+                                        DEFAULT_TEST_OUTPUT_MAX_SIZE, TEST_OUTPUT_CHUNK_SIZE)
+    from morocco.core.services import get_setting
+
+    max_size = int(get_setting('test_output_max_size', DEFAULT_TEST_OUTPUT_MAX_SIZE))
+
+    async with session.get(url) as response:
+        length = response.content_length or 0
+        if not is_test_output_too_large(length, max_size):
+            extractor = TestOutputExtractor(max_size)
+            async for chunk in response.content.iter_chunked(TEST_OUTPUT_CHUNK_SIZE):
+                extractor.feed(chunk)
+            return extractor.result()
+
+    async with session.get(url, headers=get_test_output_tail_range(length, max_size)) as response:
+        extractor = TestOutputExtractor(max_size, tail=True)
+        async for chunk in response.content.iter_chunked(TEST_OUTPUT_CHUNK_SIZE):
+            extractor.feed(chunk)
+        return extractor.result()
+
+
+def _get_db_pool_capacity() -> int:
+    """The connections the SQLAlchemy pool hands out, its size and overflow, which default to 5 and 10."""
+    from morocco.application import app
+    return int(app.config.get('SQLALCHEMY_POOL_SIZE') or 5) + int(app.config.get('SQLALCHEMY_MAX_OVERFLOW') or 10)
+
+
+def _run(request: web.Request, func, *args):
+    return asyncio.get_event_loop().run_in_executor(request.app['executor'], func, *args)
+
+
+async def _start_http_session(callback_app: web.Application) -> None:
+    callback_app['http'] = ClientSession()
+
+
+async def _close_http_session(callback_app: web.Application) -> None:
+    await callback_app['http'].close()
+    callback_app['executor'].shutdown(wait=False)
+
+
+# The functions below run on the thread pool.
+
+def _append_event(source: str, content: str) -> None:
+    from morocco.eventlog import get_event_log
+    get_event_log().append(source=source, content=content)
+
+
+def _get_task(job_id: str, task_id: str):
+    from morocco.core import get_batch_client
+    return get_batch_client().task.get(job_id, task_id)
+
+
+def _get_job(job_id: str):
+    from morocco.batch import get_job
+    return get_job(job_id)
+
+
+def _get_test_output_url(job_id: str, task_id: str) -> str:
+    from morocco.core import get_blob_storage_client
+    from morocco.core.ingestion import get_test_output_url
+    return get_test_output_url(get_blob_storage_client(), job_id, task_id)
+
+
+def _save_test_case(job_id: str, state: str, task, outputs: dict) -> None:
+    from morocco.application import app, db
+    from morocco.models import DbTestRun
+    from morocco.core.ingestion import ingest_test_tasks
+
+    with app.app_context():
+        try:
+            test_run = DbTestRun.query.filter_by(id=job_id).first()
+            test_run.state = state
+            ingest_test_tasks(test_run, [task], outputs=outputs)
+            db.session.commit()
+        finally:
+            db.session.remove()
+
+
+def _dispatch_flask_request(method: str, path: str, headers: dict, body: bytes):
+    from morocco.application import app, db
+
+    with app.test_request_context(path, method=method, headers=headers, data=body,
+                                  base_url='{}://{}'.format('https', headers.get('Host', 'localhost'))):
+        try:
+            response = app.full_dispatch_request()
+            return response.status_code, dict(response.headers), response.get_data()
+        except Exception:  # pylint: disable=broad-except
+            get_logger('callbacks').exception('Fail to handle %s', path)
+            return 500, {}, b'Internal error'
+        finally:
+            db.session.remove()
@@ -0,0 +1,57 @@
+import click
+
+from .application import app
+
+
+@app.cli.command()
+@click.option('--poll-interval', default=5.0, help='Seconds to wait before polling an empty queue again.')
+def worker(poll_interval):
+    """Run the queued background jobs."""
+    from morocco.background import run_worker
+    run_worker(poll_interval)
+
+
+@app.cli.command('flush-events')
+def flush_events():
+    """Flush the queued webhook events to the database."""
+    from morocco.eventlog import get_event_log
+    get_event_log().flush()
+
+
+@app.cli.command()
+@click.option('--days', type=int, default=None, help='Retention in days. Defaults to MOROCCO_RETENTION_DAYS.')
+def compact(days):
+    """Move the webhook payloads and test outputs older than the retention into the archive blobs."""
+    from morocco.retention import get_retention_cutoff, compact_webhook_events, compact_test_outputs
+
+    cutoff = get_retention_cutoff(days)
+    click.echo('Archived {} webhook events'.format(compact_webhook_events(cutoff)))
+    click.echo('Archived the output of {} test cases'.format(compact_test_outputs(cutoff)))
+
+
+@app.cli.command('backfill-tree-sha')
+@click.option('--limit', default=500, help='The number of the latest builds to look up on GitHub.')
+def backfill_tree_sha(limit):
+    """Record the source tree of the builds synced before it was recorded, so their artifacts can be reused."""
+    from morocco.core.operations import backfill_tree_shas
+    click.echo('Updated {} builds'.format(backfill_tree_shas(limit)))
+
+
+@app.cli.command()
+@click.option('--host', default='0.0.0.0', help='The interface to listen on.')
+@click.option('--port', default=5001, help='The port to listen on.')
+def callbacks(host, port):
+    """Serve the batch callbacks, /api/hook and /api/build, on an asyncio event loop."""
+    from aiohttp import web
+    from morocco.callbacks import create_callback_app
+
+    web.run_app(create_callback_app(), host=host, port=port)
+
+
+@app.cli.command()
+@click.option('--interval', type=float, default=None, help='Seconds between polls. Defaults to MOROCCO_POLL_INTERVAL.')
+@click.option('--once', is_flag=True, help='Poll once and exit.')
+def poller(interval, once):
+    """Poll the Batch jobs and reconcile the state of the builds and the test runs."""
+    from morocco.poller import run_poller
+    run_poller(interval, once)
@@ -3,5 +3,9 @@
 from morocco.core.config import load_config
 from morocco.core.services import (get_batch_client, get_batch_pool, get_source_control_info, get_blob_storage_client,
                                    get_automation_actor_info, get_storage_account_info, get_batch_account_info,
-                                   get_source_control_commits, get_source_control_commit)
-from morocco.core.operations import (sync_build, on_github_push)
+                                   get_source_control_commits, get_source_control_commit, get_setting,
+                                   iter_source_control_commits, get_container_sas,
+                                   get_source_control_comparison)
+from morocco.core.ingestion import ingest_test_tasks
+from morocco.core.operations import (sync_build, sync_builds, on_github_push, refresh_test_run,
+                                     update_build_download_url)
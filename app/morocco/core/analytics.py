@@ -0,0 +1,98 @@
+"""
+Test duration analytics
+
+The durations of the last MOROCCO_DURATION_WINDOW passed runs of every test, and their 50th and 95th percentiles, are
+kept in db_test_duration as the test cases are ingested. The failed runs are left out since a failure, e.g. a timeout,
+doesn't take as long as the test. The total duration and the number of the passed runs of every test of a build are
+summed up in db_build_test_duration alike, so the duration regressions between two builds are found by comparing the
+average durations of the tests without reading their test cases.
+"""
+
+import math
+from collections import defaultdict, namedtuple
+from typing import Iterable, List
+
+DEFAULT_DURATION_WINDOW = 20
+DEFAULT_REGRESSION_RATIO = 1.5
+DEFAULT_REGRESSION_MIN_DELTA = 5  # in seconds
+
+DurationRegression = namedtuple('DurationRegression', ['test_full_name', 'module', 'base_duration', 'head_duration',
+                                                       'p50', 'p95'])
+
+
+def get_percentile(values: List[int], percentile: int) -> int:
+    """The nearest-rank percentile of the values."""
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(percentile / 100 * len(ordered))) - 1)]
+
+
+def record_test_durations(test_cases: Iterable, build_id: str = None) -> None:
+    """
+    Add the durations of the passed test cases to the statistics of their tests, and to the ones of the build if it is
+    given. The caller commits the session.
+    """
+    from sqlalchemy.dialects.postgresql import insert
+    from morocco.application import db
+    from morocco.core.history import append_to_windows
+    from morocco.core.services import get_setting
+    from morocco.models import DbBuildTestDuration, DbTestDuration
+
+    window = int(get_setting('duration_window', DEFAULT_DURATION_WINDOW))
+    test_cases = [t for t in test_cases if t.passed and t.test_duration is not None]
+    durations = defaultdict(list)
+    for test_case in test_cases:
+        durations[test_case.test_full_name].append(str(test_case.test_duration))
+
+    for statistic in append_to_windows(DbTestDuration, 'durations', durations, window, ',').values():
+        latest = statistic.get_durations()
+        statistic.p50 = get_percentile(latest, 50)
+        statistic.p95 = get_percentile(latest, 95)
+
+    if not build_id or not test_cases:
+        return
+
+    modules = {t.test_full_name: t.module for t in test_cases}
+    table = DbBuildTestDuration.__table__
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.build_id, table.c.test_full_name],
+        set_={table.c.total_duration.name: table.c.total_duration + statement.excluded.total_duration,
+              table.c.runs.name: table.c.runs + statement.excluded.runs})
+    db.session.execute(statement, [{'build_id': build_id,
+                                    'test_full_name': name,
+                                    'module': modules[name],
+                                    'total_duration': sum(int(d) for d in values),
+                                    'runs': len(values)} for name, values in sorted(durations.items())])
+
+
+def get_duration_regressions(base_build_id: str, head_build_id: str, ratio: float = DEFAULT_REGRESSION_RATIO,
+                             min_delta: int = DEFAULT_REGRESSION_MIN_DELTA) -> List[DurationRegression]:
+    """
+    The tests which take at least ratio times and min_delta seconds longer in the test runs of the head build than in
+    the ones of the base build, the largest regression first.
+    """
+    from morocco.models import DbTestDuration
+
+    base = _get_build_test_durations(base_build_id)
+    head = _get_build_test_durations(head_build_id)
+
+    regressed = {name: (module, base[name][1], duration) for name, (module, duration) in head.items()
+                 if name in base and duration >= base[name][1] * ratio and duration - base[name][1] >= min_delta}
+    if not regressed:
+        return []
+
+    statistics = {s.test_full_name: s for s in DbTestDuration.query.filter(
+        DbTestDuration.test_full_name.in_(list(regressed)))}
+    regressions = [DurationRegression(name, module, base_duration, head_duration,
+                                      statistics[name].p50 if name in statistics else None,
+                                      statistics[name].p95 if name in statistics else None)
+                   for name, (module, base_duration, head_duration) in regressed.items()]
+
+    return sorted(regressions, key=lambda r: r.head_duration - r.base_duration, reverse=True)
+
+
+def _get_build_test_durations(build_id: str) -> dict:
+    from morocco.models import DbBuildTestDuration
+
+    return {d.test_full_name: (d.module, d.total_duration / d.runs)
+            for d in DbBuildTestDuration.query.filter_by(build_id=build_id) if d.runs}
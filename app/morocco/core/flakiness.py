@@ -0,0 +1,102 @@
+"""
+Flaky test detection and retry
+
+Every ingested test case appends its outcome to the rolling window of the last MOROCCO_FLAKE_WINDOW outcomes of its
+test in db_test_history. The flake rate of a test is the share of its consecutive outcomes which differ. When a test
+whose flake rate is at least MOROCCO_FLAKE_THRESHOLD fails in a running job, a copy of its task is added to the job, up
+to MOROCCO_FLAKY_TEST_RETRIES times. The retry is recorded as a test case of its own, the next attempt of the test,
+and the test run counts the test by its final attempt. A test which ran in a shard, see morocco.core.sharding, has no
+task of its own to copy, so it isn't retried, though its outcome is still recorded.
+"""
+
+import re
+from collections import defaultdict
+from typing import Iterable
+
+from morocco.util import get_logger
+
+DEFAULT_FLAKE_WINDOW = 20
+DEFAULT_FLAKE_THRESHOLD = 0.2
+DEFAULT_FLAKY_TEST_RETRIES = 1
+
+RETRY_SUFFIX = '-retry-'
+
+
+def record_test_outcomes(test_cases: Iterable) -> None:
+    """Append the outcomes of the test cases to the history of their tests. The caller commits the session."""
+    from morocco.core.history import append_to_windows
+    from morocco.core.services import get_setting
+    from morocco.models import DbTestHistory
+
+    window = int(get_setting('flake_window', DEFAULT_FLAKE_WINDOW))
+    outcomes, test_run_ids = defaultdict(list), {}
+    for test_case in test_cases:
+        outcomes[test_case.test_full_name].append('P' if test_case.passed else 'F')
+        test_run_ids[test_case.test_full_name] = test_case.test_run_id
+
+    for name, history in append_to_windows(DbTestHistory, 'outcomes', outcomes, window).items():
+        history.last_test_run_id = test_run_ids[name]
+
+
+def retry_flaky_tests(job_id: str, test_cases: Iterable) -> int:
+    """Add a retry of the failed test cases of the known flaky tests to the job. Returns the number of retries."""
+    from azure.batch.models import TaskAddParameter
+    from morocco.core.services import get_batch_client, get_setting
+    from morocco.core.sharding import SHARD_TASK_PREFIX
+    from morocco.models import DbTestHistory
+
+    retries = int(get_setting('flaky_test_retries', DEFAULT_FLAKY_TEST_RETRIES))
+    threshold = float(get_setting('flake_threshold', DEFAULT_FLAKE_THRESHOLD))
+
+    # the id of a test case is the job id and the task id, which for a test of a shard isn't the id of a Batch task
+    failed = {t.id[len(job_id) + 1:]: t for t in test_cases if not t.passed}
+    failed = {task_id: t for task_id, t in failed.items() if not task_id.startswith(SHARD_TASK_PREFIX)}
+    failed = {task_id: t for task_id, t in failed.items() if get_attempt(task_id) < retries}
+    if not failed:
+        return 0
+
+    flaky = {h.test_full_name for h in DbTestHistory.query.filter(
+        DbTestHistory.test_full_name.in_(list({t.test_full_name for t in failed.values()})))
+             if h.get_flake_rate() >= threshold}
+
+    count = 0
+    batch_client = get_batch_client()
+    for task_id in (task_id for task_id, t in failed.items() if t.test_full_name in flaky):
+        retry_id = '{}{}{}'.format(task_id.split(RETRY_SUFFIX)[0], RETRY_SUFFIX, get_attempt(task_id) + 1)
+        try:
+            task = batch_client.task.get(job_id, task_id)
+            batch_client.task.add(job_id, TaskAddParameter(
+                id=retry_id,
+                command_line=_get_retry_command_line(task.command_line, task_id, retry_id),
+                display_name=task.display_name,
+                resource_files=task.resource_files,
+                environment_settings=task.environment_settings,
+                output_files=_get_retry_output_files(task.output_files, task_id, retry_id),
+                constraints=task.constraints,
+                user_identity=task.user_identity))
+            count += 1
+        except Exception:  # pylint: disable=broad-except
+            # the job terminates once all its tasks completed, so the retry of the last failed task may be too late
+            get_logger('flakiness').exception('Fail to retry task %s of job %s', task_id, job_id)
+
+    return count
+
+
+def get_attempt(task_id: str) -> int:
+    """The attempt of the test of the task, 0 for its first run and n for its nth retry."""
+    _, _, attempt = task_id.rpartition(RETRY_SUFFIX)
+    return int(attempt) if RETRY_SUFFIX in task_id and attempt.isdigit() else 0
+
+
+def _get_retry_command_line(command_line: str, task_id: str, retry_id: str) -> str:
+    """Replace the task id in the command line, e.g. in its callback, so the retry reports as itself."""
+    return re.sub(r'(?<![\w-]){}(?![\w-])'.format(re.escape(task_id)), retry_id, command_line)
+
+
+def _get_retry_output_files(output_files, task_id: str, retry_id: str):
+    """Upload the outputs of the retry to its own folder, next to the one of the retried task."""
+    for output_file in output_files or []:
+        container = output_file.destination.container
+        if container and container.path:
+            container.path = container.path.replace('/{}/'.format(task_id), '/{}/'.format(retry_id))
+    return output_files
@@ -0,0 +1,92 @@
+"""
+GitHub API requests with a conditional request cache and Link header pagination
+
+The response of every GET is saved in the db_http_cache table with its ETag and Last-Modified headers, keyed by the URL
+without the client credentials. The next request of the same URL sends them back, and a 304 Not Modified response, which
+GitHub doesn't count against the rate limit, is answered from the cache.
+"""
+
+import json
+from collections import namedtuple
+from datetime import datetime
+from typing import Iterator, Union
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import requests
+
+from morocco.util import get_logger
+
+GithubResponse = namedtuple('GithubResponse', ['content', 'next_url'])
+
+_CREDENTIAL_PARAMS = ('client_id', 'client_secret')
+
+
+def github_get(url: str) -> GithubResponse:
+    """GET the JSON content of a GitHub API URL. The content is None if the request fails."""
+    from sqlalchemy.dialects.postgresql import insert
+    from morocco.application import db
+    from morocco.models import DbHttpCache
+    from morocco.core.services import get_github_app_info
+
+    url = _strip_credentials(url)
+    table = DbHttpCache.__table__
+
+    # the cache is accessed on its own connection so that it doesn't commit or roll back the caller's session
+    cached = db.engine.execute(table.select().where(table.c.url == url)).first()
+
+    headers = {}
+    if cached and cached.etag:
+        headers['If-None-Match'] = cached.etag
+    if cached and cached.last_modified:
+        headers['If-Modified-Since'] = cached.last_modified
+
+    credential = get_github_app_info()
+    response = requests.get(url, params={'client_id': credential.id, 'client_secret': credential.secret},
+                            headers=headers)
+
+    if response.status_code == 304 and cached:
+        get_logger('github').info('Not modified: %s', url)
+        return GithubResponse(json.loads(cached.content), cached.next_url)
+
+    if response.status_code != 200:
+        get_logger('github').warning('Request %s failed: %s', url, response.status_code)
+        return GithubResponse(None, None)
+
+    next_url = response.links.get('next', {}).get('url')
+    next_url = _strip_credentials(next_url) if next_url else None
+
+    etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+    if etag or last_modified:
+        # upsert, so concurrent requests of the same URL don't fail on its primary key, the last one wins
+        values = {'etag': etag, 'last_modified': last_modified, 'next_url': next_url, 'content': response.text,
+                  'time': datetime.utcnow()}
+        with db.engine.begin() as connection:
+            connection.execute(insert(table).values(url=url, **values)
+                               .on_conflict_do_update(index_elements=[table.c.url], set_=values))
+
+    return GithubResponse(response.json(), next_url)
+
+
+def iter_github_pages(url: str, max_pages: Union[int, None] = None) -> Iterator[list]:
+    """
+    Follow the next links of a paginated GitHub API, yielding the content of every page. Raises ValueError if a page
+    after the first fails, e.g. on the rate limit, rather than end the listing early, since the caller would take the
+    pages it got for all of them.
+    """
+    count = 0
+    while url and (max_pages is None or count < max_pages):
+        page_url = url
+        content, url = github_get(url)
+        if content is None:
+            if count:
+                raise ValueError('Fail to get page {} of the GitHub listing, {}'.format(count + 1, page_url))
+            return
+
+        yield content
+        count += 1
+
+
+def _strip_credentials(url: str) -> str:
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query) if k not in _CREDENTIAL_PARAMS]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), parts.fragment))
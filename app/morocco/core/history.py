@@ -0,0 +1,39 @@
+"""
+Rolling windows of the latest values of the tests
+
+The outcome history of morocco.core.flakiness and the duration statistics of morocco.core.analytics keep the latest
+values of every test in a string column of a table keyed by the test full name. The ingestions of concurrent callbacks
+append to the same rows, so the missing rows are inserted with INSERT ... ON CONFLICT DO NOTHING, and all the rows
+are locked with SELECT ... FOR UPDATE, in the order of their names so two ingestions can't deadlock, before their
+windows are rewritten. The locks are held until the caller commits the session.
+"""
+
+from typing import Dict, List
+
+
+def append_to_windows(model, column: str, values: Dict[str, List[str]], window: int, separator: str = '') -> dict:
+    """
+    Append the values to the windows of the tests by their full name, keeping the latest window ones. Returns the
+    locked rows by the test full name. The caller commits the session.
+    """
+    from sqlalchemy.dialects.postgresql import insert
+    from morocco.application import db
+
+    if not values:
+        return {}
+
+    names = sorted(values)
+    db.session.execute(insert(model.__table__).on_conflict_do_nothing(),
+                       [{'test_full_name': name, column: ''} for name in names])
+    rows = model.query.filter(model.test_full_name.in_(names)) \
+        .order_by(model.test_full_name) \
+        .with_for_update() \
+        .populate_existing() \
+        .all()
+
+    for row in rows:
+        current = getattr(row, column)
+        latest = (current.split(separator) if separator else list(current)) if current else []
+        setattr(row, column, separator.join((latest + values[row.test_full_name])[-window:]))
+
+    return {row.test_full_name: row for row in rows}
@@ -0,0 +1,185 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import partial
+from typing import Callable, Dict, Iterable, List
+
+from azure.batch.models import CloudTask
+
+from morocco.util import get_logger
+
+DEFAULT_INGESTION_CONCURRENCY = 8
+DEFAULT_INGESTION_CHUNK_SIZE = 500
+DEFAULT_TEST_OUTPUT_MAX_SIZE = 256 * 1024  # in bytes
+TEST_OUTPUT_CHUNK_SIZE = 64 * 1024
+
+# the lines the test runner writes before and after the output of a test in stdout.txt
+_TEST_OUTPUT_HEADER = 58
+_TEST_OUTPUT_FOOTER = 3
+# the extra bytes requested in front of the tail, large enough for the footer lines
+_TEST_OUTPUT_RANGE_MARGIN = 16 * 1024
+
+IngestionResult = namedtuple('IngestionResult', ['test_cases', 'pending_tasks'])
+
+
+def get_test_output_url(storage, job_id: str, task_id: str) -> str:
+    from azure.storage.blob.models import ContainerPermissions
+    from morocco.core.services import get_container_sas
+
+    sas = get_container_sas('output', ContainerPermissions(read=True), timedelta(hours=1))
+    return storage.make_blob_url('output', os.path.join(job_id, task_id, 'stdout.txt'), sas_token=sas, protocol='https')
+
+
+def fetch_test_output(url: str, max_size: int = DEFAULT_TEST_OUTPUT_MAX_SIZE) -> str:
+    """
+    Download the output of a test from its stdout.txt blob, without the fixed header and footer lines the test runner
+    writes, and keep at most the last max_size bytes of it.
+
+    The blob is streamed in chunks and only a ring buffer of the trailing lines is kept in memory. If the blob is much
+    larger than max_size, the download is restarted with a Range request of just its tail.
+    """
+    import requests
+
+    with requests.get(url, stream=True) as response:
+        length = int(response.headers.get('Content-Length') or 0)
+        if not is_test_output_too_large(length, max_size):
+            extractor = TestOutputExtractor(max_size)
+            for chunk in response.iter_content(TEST_OUTPUT_CHUNK_SIZE):
+                extractor.feed(chunk)
+            return extractor.result()
+
+    with requests.get(url, headers=get_test_output_tail_range(length, max_size), stream=True) as response:
+        extractor = TestOutputExtractor(max_size, tail=True)
+        for chunk in response.iter_content(TEST_OUTPUT_CHUNK_SIZE):
+            extractor.feed(chunk)
+        return extractor.result()
+
+
+def is_test_output_too_large(length: int, max_size: int) -> bool:
+    return length > max_size + _TEST_OUTPUT_RANGE_MARGIN
+
+
+def get_test_output_tail_range(length: int, max_size: int) -> dict:
+    return {'Range': 'bytes={}-'.format(length - max_size - _TEST_OUTPUT_RANGE_MARGIN)}
+
+
+class TestOutputExtractor(object):
+    """
+    Incrementally compute '\n'.join(text.split('\n')[58:-3]) of a stdout.txt fed in chunks, capped at max_size bytes.
+    The numbers of the header and footer lines can be given for the outputs of other formats.
+
+    For the tail of a blob downloaded with a Range request, the header lines are far behind, so only the first line,
+    which is probably cut, is skipped.
+    """
+
+    def __init__(self, max_size: int, tail: bool = False, header: int = _TEST_OUTPUT_HEADER,
+                 footer: int = _TEST_OUTPUT_FOOTER):
+        from collections import deque
+
+        self._max_size = max_size
+        self._skip = 1 if tail else header
+        self._footer = footer
+        self._truncated = tail
+        self._lines = deque()
+        self._size = 0  # the size of the lines in the buffer, excluding the footer lines at its end
+        self._remainder = b''
+
+    def feed(self, chunk: bytes) -> None:
+        *lines, self._remainder = (self._remainder + chunk).split(b'\n')
+        for line in lines:
+            self._append(line)
+
+    def result(self) -> str:
+        self._append(self._remainder)
+        self._remainder = b''
+
+        text = b'\n'.join(list(self._lines)[:max(0, len(self._lines) - self._footer)]).decode('utf-8', errors='replace')
+        return '[truncated to the last {} bytes]\n{}'.format(self._max_size, text) if self._truncated else text
+
+    def _append(self, line: bytes) -> None:
+        if self._skip:
+            self._skip -= 1
+            return
+
+        lines = self._lines
+        lines.append(line)
+        if len(lines) > self._footer:
+            self._size += len(lines[-self._footer - 1]) + 1
+        while self._size > self._max_size and len(lines) > self._footer:
+            self._size -= len(lines.popleft()) + 1
+            self._truncated = True
+
+
+def ingest_test_tasks(test_run, tasks: Iterable[CloudTask], progress: Callable[[int, int], None] = None,
+                      outputs: Dict[str, str] = None) -> IngestionResult:
+    """
+    Insert the test cases of the finished tasks which are not yet recorded for the test run.
+
+    The listed tasks which are already recorded are looked up in chunks. The output of the failed tests are downloaded
+    on a thread pool of MOROCCO_INGESTION_CONCURRENCY workers, and the new test cases are inserted and committed in
+    chunks of MOROCCO_INGESTION_CHUNK_SIZE. At most MOROCCO_TEST_OUTPUT_MAX_SIZE bytes of an output are kept. The
+    optional progress callback is called with the number of ingested and new tasks after every chunk. The outputs which
+    the caller already downloaded can be given by task id. A shard task is ingested as the tests it ran, or returned as
+    pending if its results can't be read yet. The outcomes and durations are added to the test history and analytics,
+    and the failed known flaky tests of a running job are retried.
+    """
+    from morocco.application import db
+    from morocco.models import DbTestCase
+    from morocco.core.services import get_blob_storage_client, get_setting
+    from morocco.core.analytics import record_test_durations
+    from morocco.core.flakiness import record_test_outcomes, retry_flaky_tests
+    from morocco.core.sharding import expand_shard_tasks
+
+    logger = get_logger('ingestion')
+    concurrency = int(get_setting('ingestion_concurrency', DEFAULT_INGESTION_CONCURRENCY))
+    chunk_size = int(get_setting('ingestion_chunk_size', DEFAULT_INGESTION_CHUNK_SIZE))
+    max_output_size = int(get_setting('test_output_max_size', DEFAULT_TEST_OUTPUT_MAX_SIZE))
+
+    # the shard tasks are ingested as the tests they ran
+    tasks, shard_outputs, pending = expand_shard_tasks(test_run.id, (t for t in tasks if t.id != 'test-creator'),
+                                                       job_completed=test_run.state == 'completed')
+    outputs = dict(outputs or {}, **shard_outputs)
+
+    # look up only the listed tasks, so an incremental refresh doesn't read every test case of the run
+    names = [DbTestCase.get_full_name(t, test_run) for t in tasks]
+    existing = set()
+    for start in range(0, len(names), chunk_size):
+        existing.update(row.id for row in db.session.query(DbTestCase.id)
+                        .filter(DbTestCase.id.in_(names[start:start + chunk_size])))
+    tasks = [t for t in tasks if DbTestCase.get_full_name(t, test_run) not in existing]
+    logger.info('Ingest %d new tasks of test run %s', len(tasks), test_run.id)
+
+    storage = get_blob_storage_client()
+    ingested = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for start in range(0, len(tasks), chunk_size):
+            chunk = [(task, DbTestCase(task, test_run)) for task in tasks[start:start + chunk_size]]
+
+            # only load output of failed tests for performance reason
+            failed = [(task, test_case) for task, test_case in chunk if not test_case.passed]
+            for task, test_case in (f for f in failed if outputs and f[0].id in outputs):
+                test_case.output = outputs[task.id]
+            failed = [(task, test_case) for task, test_case in failed if not outputs or task.id not in outputs]
+            urls = [get_test_output_url(storage, test_run.id, task.id) for task, _ in failed]
+            # a name of its own, rebinding the outputs argument would lose the preloaded outputs of the next chunks
+            downloaded = executor.map(partial(fetch_test_output, max_size=max_output_size), urls)
+            for (_, test_case), output in zip(failed, downloaded):
+                test_case.output = output
+
+            test_cases = [test_case for _, test_case in chunk]
+            db.session.bulk_save_objects(test_cases)
+            db.session.bulk_save_objects([t.output_record for t in test_cases if t.output_record])
+            test_run.record_test_cases(test_cases)
+            record_test_outcomes(test_cases)
+            record_test_durations(test_cases, test_run.build_id)
+            db.session.commit()
+
+            if test_run.state == 'active':
+                retry_flaky_tests(test_run.id, test_cases)
+
+            ingested.extend(test_cases)
+            if progress:
+                progress(len(ingested), len(tasks))
+
+    return IngestionResult(ingested, pending)
@@ -1,79 +1,295 @@
-from typing import Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import Callable, List, Tuple, Union
 
+from morocco.util import get_logger
 
-def sync_build(commit: dict = None, sha: str = None, create_job=False):
-    from datetime import datetime, timedelta
+DEFAULT_SCHEDULING_CONCURRENCY = 8
+DEFAULT_SCHEDULING_BATCH_SIZE = 50
 
-    from azure.batch.models import BatchErrorException, JobState
-    from azure.storage.blob.models import BlobPermissions
+# the tasks completed this long before the high-water mark of a test run are listed again by refresh_test_run
+_TASK_END_TIME_OVERLAP = timedelta(minutes=5)
 
-    from morocco.core.services import (get_source_control_commit, get_source_control_commits, get_batch_client,
-                                       get_blob_storage_client)
-    from morocco.main import DbBuild, db
-    from morocco.batch import create_build_job
+
+def sync_build(commit: dict = None, sha: str = None, create_job=False, rebuild=False):
+    from morocco.core.services import get_source_control_commit, get_source_control_commits
 
     if not dict and not sha:
         raise ValueError('Missing commit')
 
     if not commit:
         if sha == '<latest>':
-            commit = get_source_control_commits()[0]
+            commit = get_source_control_commits(max_pages=1)[0]
         else:
             commit = commit or get_source_control_commit(sha)
 
-    sha = commit['sha']
+    return sync_builds([commit], create_job, rebuild=rebuild)[0]
 
-    build_record = DbBuild.query.filter_by(id=sha).one_or_none()
-    if build_record:
-        build_record.update_commit(commit)
-    else:
-        build_record = DbBuild(commit=commit)
-        db.session.add(build_record)
 
+def sync_builds(commits: List[dict], create_job=False, progress: Callable[[int, int], None] = None,
+                rebuild=False) -> List:
+    """
+    Sync the builds of the commits, and schedule their build jobs if create_job is set. With rebuild, the commits are
+    built even if an artifact of their source tree exists.
+
+    The Batch and storage calls of the commits are fanned out on a thread pool of MOROCCO_SCHEDULING_CONCURRENCY
+    workers, and the builds are committed to the database once per batch of MOROCCO_SCHEDULING_BATCH_SIZE commits. The
+    optional progress callback is called with the number of synced and all commits after every batch.
+    """
+    from flask import url_for
+    from morocco.core.services import get_setting
+    from morocco.application import db
+    from morocco.models import DbBuild
+
+    concurrency = int(get_setting('scheduling_concurrency', DEFAULT_SCHEDULING_CONCURRENCY))
+    batch_size = int(get_setting('scheduling_batch_size', DEFAULT_SCHEDULING_BATCH_SIZE))
+
+    # the callback URL is resolved here because the worker threads have no request context
+    callback_url = url_for('post_api_build', _external=True, _scheme='https') if create_job else None
+
+    commits = list(OrderedDict((c['sha'], c) for c in commits).values())
+    builds = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for start in range(0, len(commits), batch_size):
+            batch = commits[start:start + batch_size]
+            existing = {b.id: b for b in DbBuild.query.filter(DbBuild.id.in_([c['sha'] for c in batch]))}
+
+            batch_builds = []
+            for commit in batch:
+                build_record = existing.get(commit['sha'])
+                if build_record:
+                    build_record.update_commit(commit)
+                else:
+                    build_record = DbBuild(commit=commit)
+                    db.session.add(build_record)
+                batch_builds.append(build_record)
+
+            # the builds of the same source tree whose artifacts can be reused instead of building the commits
+            artifacts = {}
+            tree_shas = [b.tree_sha for b in batch_builds if b.tree_sha]
+            if create_job and not rebuild and tree_shas:
+                for row in db.session.query(DbBuild.id, DbBuild.tree_sha) \
+                        .filter(DbBuild.tree_sha.in_(tree_shas)) \
+                        .filter(DbBuild.build_download_url.isnot(None)):
+                    artifacts.setdefault(row.tree_sha, row.id)
+            sources = [artifacts.get(b.tree_sha) if artifacts.get(b.tree_sha) != b.id else None for b in batch_builds]
+
+            # of the commits of a source tree without an artifact, only the first is built, the others get a copy of its
+            # artifact when it finishes, see share_build_artifact
+            builders, create_jobs = {}, []
+            for build_record in batch_builds:
+                tree_sha = build_record.tree_sha
+                if create_job and not rebuild and tree_sha and tree_sha not in artifacts:
+                    create_jobs.append(builders.setdefault(tree_sha, build_record.id) == build_record.id)
+                else:
+                    create_jobs.append(create_job)
+
+            results = executor.map(partial(_sync_build_job, callback_url=callback_url, rebuild=rebuild),
+                                   [b.id for b in batch_builds], sources, create_jobs)
+            for build_record, (state, download_url) in zip(batch_builds, results):
+                # build job can be deleted. it is not required to keep data in sync
+                if state:
+                    build_record.state = state
+                if download_url:
+                    build_record.build_download_url = download_url
+
+            db.session.commit()
+
+            builds.extend(batch_builds)
+            if progress:
+                progress(len(builds), len(commits))
+
+    return builds
+
+
+def _sync_build_job(sha: str, artifact_source: Union[str, None], create_job: bool, callback_url: str,
+                    rebuild: bool = False) -> Tuple[Union[str, None], Union[str, None]]:
+    """
+    Return the state of the build task and the download URL of the build. It runs on the worker threads.
+
+    A commit without a build job isn't built if its artifact exists, or if the artifact of the build of the same source
+    tree, artifact_source, can be copied to it, unless it is rebuilt.
+    """
+    from azure.batch.models import BatchErrorException, JobState
+    from morocco.core.services import get_batch_client
+    from morocco.batch import create_build_job
+
+    batch_client = get_batch_client()
     try:
-        batch_client = get_batch_client()
-        batch_job = batch_client.job.get(sha)
-        if create_job and batch_job.state == JobState.completed:
-            batch_client.job.delete(sha)
-            batch_job = create_build_job(sha)
-    except BatchErrorException:
-        if create_job:
-            batch_job = create_build_job(sha)
-        else:
-            batch_job = None
+        try:
+            batch_job = batch_client.job.get(sha)
+            if create_job and batch_job.state == JobState.completed:
+                batch_client.job.delete(sha)
+                create_build_job(sha, callback_url)
+                return 'active', get_build_download_url(sha)
+        except BatchErrorException:
+            download_url = get_build_download_url(sha)
+            if not create_job:
+                return None, download_url
+
+            if not rebuild:
+                download_url = download_url or (_copy_build_artifact(artifact_source, sha) if artifact_source else None)
+                if download_url:
+                    return 'completed', download_url
+
+            create_build_job(sha, callback_url)
+            return 'active', get_build_download_url(sha)
+
+        return batch_client.task.get(job_id=sha, task_id='build').state.value, get_build_download_url(sha)
+    except Exception:  # pylint: disable=broad-except
+        get_logger('build').exception('Fail to sync build %s', sha)
+        return None, None
+
+
+def _copy_build_artifact(source_sha: str, sha: str) -> Union[str, None]:
+    """Copy the build artifact of another commit of the same source tree. Returns the download URL of the copy."""
+    from azure.storage.blob.models import ContainerPermissions
+    from morocco.core.services import get_blob_storage_client, get_container_sas
+
+    storage = get_blob_storage_client()
+    source_url = storage.make_blob_url('builds', 'azure-cli-{}.tar'.format(source_sha), protocol='https',
+                                       sas_token=get_container_sas('builds', ContainerPermissions(read=True),
+                                                                   timedelta(hours=1)))
+    try:
+        # a copy within the storage account completes before the call returns
+        copy = storage.copy_blob('builds', 'azure-cli-{}.tar'.format(sha), source_url)
+    except Exception:  # pylint: disable=broad-except
+        get_logger('build').exception('Fail to copy the artifact of build %s to %s', source_sha, sha)
+        return None
+
+    if copy.status != 'success':
+        get_logger('build').warning('The copy of the artifact of build %s to %s is %s', source_sha, sha, copy.status)
+        return None
+
+    get_logger('build').info('Reuse the artifact of build %s of the same source tree for %s', source_sha, sha)
+    return get_build_download_url(sha)
+
+
+def share_build_artifact(sha: str) -> int:
+    """
+    Copy the artifact of the finished build to the builds of the same source tree which were never built, because they
+    were synced in the same batch. Returns the number of copies.
+    """
+    from morocco.application import db
+    from morocco.models import DbBuild
+
+    build_record = DbBuild.query.filter_by(id=sha).one_or_none()
+    if not build_record or not build_record.tree_sha or not build_record.build_download_url:
+        return 0
+
+    count = 0
+    for other in DbBuild.query.filter(DbBuild.tree_sha == build_record.tree_sha, DbBuild.id != sha,
+                                      DbBuild.build_download_url.is_(None), DbBuild.state == 'init'):
+        download_url = _copy_build_artifact(sha, other.id)
+        if download_url:
+            other.build_download_url = download_url
+            other.state = 'completed'
+            count += 1
+    db.session.commit()
+
+    return count
+
+
+def backfill_tree_shas(limit: int) -> int:
+    """
+    Set the source tree of the latest builds with an artifact which were synced before the tree was recorded, so their
+    artifacts can be reused. Returns the number of builds updated.
+    """
+    from morocco.application import db
+    from morocco.core.services import get_source_control_commit
+    from morocco.models import DbBuild
+
+    count = 0
+    for build_record in DbBuild.query.filter(DbBuild.tree_sha.is_(None), DbBuild.build_download_url.isnot(None)) \
+            .order_by(DbBuild.commit_date.desc()) \
+            .limit(limit):
+        commit = get_source_control_commit(build_record.id)
+        if commit:
+            build_record.tree_sha = commit['commit'].get('tree', {}).get('sha')
+            count += 1 if build_record.tree_sha else 0
+    db.session.commit()
 
-    if batch_job:
-        # build job can be deleted. it is not required to keep data in sync
-        build_task = get_batch_client().task.get(job_id=sha, task_id='build')
-        if not build_task:
-            return 'Cloud task for the build is not found', 400
-        build_record.state = build_task.state.value
+    return count
+
+
+def get_build_download_url(sha: str) -> Union[str, None]:
+    """Return the download URL of the build if its artifact is uploaded."""
+    from azure.storage.blob.models import BlobPermissions
+    from morocco.core.services import get_blob_storage_client
 
     storage = get_blob_storage_client()
     blob = 'azure-cli-{}.tar'.format(sha)
-    if storage.exists(container_name='builds', blob_name=blob):
-        build_record.build_download_url = storage.make_blob_url(
-            'builds', blob_name=blob, protocol='https', sas_token=storage.generate_blob_shared_access_signature(
-                'builds', blob, BlobPermissions(read=True), expiry=datetime.utcnow() + timedelta(days=365)))
+    if not storage.exists(container_name='builds', blob_name=blob):
+        return None
+
+    return storage.make_blob_url(
+        'builds', blob_name=blob, protocol='https', sas_token=storage.generate_blob_shared_access_signature(
+            'builds', blob, BlobPermissions(read=True), expiry=datetime.utcnow() + timedelta(days=365)))
+
+
+def update_build_download_url(build_record) -> None:
+    """Set the download URL of the build if its artifact is uploaded."""
+    build_record.build_download_url = get_build_download_url(build_record.id) or build_record.build_download_url
+
+
+def refresh_test_run(job_id: str, progress: Callable[[int, int], None] = None, job=None):
+    """
+    Sync the state of the test run and ingest the tasks completed since the last refresh. The job is fetched from Batch
+    unless it is given.
+
+    Only the tasks which completed after the high-water mark, less an overlap for the tasks whose completion is listed
+    late, are requested from Batch, so a repeated refresh costs in proportion to the new completions.
+    """
+    from morocco.application import db
+    from morocco.models import DbTestRun
+    from morocco.batch import get_job, list_task_records
+    from morocco.core.ingestion import ingest_test_tasks
+
+    test_run = DbTestRun.query.filter_by(id=job_id).first()
+    if not test_run:
+        raise ValueError('Test run {} is not found'.format(job_id))
+
+    test_run_job = job or get_job(job_id)
+    test_run.state = test_run_job.state.value
+
+    mark = test_run.last_task_end_time
+    tasks = list(list_task_records(job_id, completed_since=mark - _TASK_END_TIME_OVERLAP if mark else None))
+    pending = ingest_test_tasks(test_run, tasks, progress).pending_tasks
+
+    end_times = [_to_naive_utc(t.execution_info.end_time) for t in tasks if t.execution_info and
+                 t.execution_info.end_time]
+    if end_times:
+        test_run.last_task_end_time = max(end_times + [mark] if mark else end_times)
+    # hold the mark back at the shards whose results aren't uploaded yet, so the next refresh lists them again
+    pending_end_times = [_to_naive_utc(t.execution_info.end_time) for t in pending]
+    if pending_end_times:
+        test_run.last_task_end_time = min(pending_end_times + [test_run.last_task_end_time])
 
     db.session.commit()
 
-    return build_record
+    return test_run
+
+
+def _to_naive_utc(value: datetime) -> datetime:
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
 
 
 def on_github_push(payload: dict) -> str:
-    from morocco.main import DbBuild
-    from morocco.core import get_source_control_commits
+    from morocco.models import DbBuild
+    from morocco.core import iter_source_control_commits
 
     if payload['ref'] != 'refs/heads/master':
         return 'Skip push on branch other than master.'
 
     last_build = DbBuild.query.order_by(DbBuild.commit_date.desc()).first()
-    commits = get_source_control_commits(since=last_build.commit_date.strftime('%Y-%m-%dT%H:%M:%SZ'))
-    for commit in commits[:-1]:
-        sync_build(commit, create_job=True)
+    # the since filter is inclusive so the last build shows up again
+    commits = [c for c in iter_source_control_commits(since=last_build.commit_date.strftime('%Y-%m-%dT%H:%M:%SZ'))
+               if c['sha'] != last_build.id]
+    sync_builds(commits, create_job=True)
 
-    return 'Success: {} build scheduled'.format(len(commits) - 1)
+    return 'Success: {} build scheduled'.format(len(commits))
 
 
 def on_batch_callback(request, db_build_model) -> Tuple[str, int]:
@@ -101,5 +317,6 @@ def on_batch_callback(request, db_build_model) -> Tuple[str, int]:
         return 'Invalid secret', 403
 
     sync_build(sha=sha, create_job=False)
+    share_build_artifact(sha)
 
     return 'OK', 200
@@ -0,0 +1,84 @@
+"""
+Test selection by the modules a build changed
+
+A selective test run runs only the tests of the command modules changed since the last tested build, plus the modules in
+MOROCCO_TEST_CORE_MODULES. The changed files are read from the GitHub compare API. A change outside the command modules,
+or a comparison GitHub can't give in full, selects every module. So does a build whose last full test run is more than
+MOROCCO_FULL_TEST_RUN_INTERVAL hours old, so every test still runs on a cadence.
+"""
+
+from datetime import datetime, timedelta
+from typing import Set, Union
+
+from morocco.util import get_logger
+
+DEFAULT_TEST_CORE_MODULES = 'CORE'
+DEFAULT_FULL_TEST_RUN_INTERVAL = 24  # in hours
+
+COMMAND_MODULES_PATH = 'src/command_modules/azure-cli-'
+
+# the files which don't change what the tests run
+_IGNORED_SUFFIXES = ('.md', '.rst')
+# the compare API lists at most this many files
+_MAX_COMPARE_FILES = 300
+
+
+def get_changed_modules(base_sha: str, head_sha: str) -> Union[Set[str], None]:
+    """The command modules changed between the commits, in the form of DbTestCase.module, or None for all of them."""
+    from morocco.core.services import get_source_control_comparison
+
+    content = get_source_control_comparison(base_sha, head_sha)
+    if not content or len(content.get('files', [])) >= _MAX_COMPARE_FILES:
+        return None
+
+    modules = set()
+    for path in (f['filename'] for f in content['files']):
+        if path.endswith(_IGNORED_SUFFIXES):
+            continue
+        if not path.startswith(COMMAND_MODULES_PATH):
+            return None
+        # src/command_modules/azure-cli-<name>/... is tested in azure.cli.command_modules.<name>
+        modules.add(path[len(COMMAND_MODULES_PATH):].split('/', 1)[0].replace('-', '_').upper())
+
+    return modules
+
+
+def select_test_modules(build_id: str) -> Union[Set[str], None]:
+    """The modules whose tests the test run of the build runs, or None for a full test run."""
+    from morocco.core.services import get_setting
+    from morocco.application import db
+    from morocco.models import DbBuild, DbTestRun
+
+    logger = get_logger('selection')
+
+    interval = timedelta(hours=int(get_setting('full_test_run_interval', DEFAULT_FULL_TEST_RUN_INTERVAL)))
+    last_full_run = DbTestRun.query.filter(DbTestRun.selection.is_(None)) \
+        .order_by(DbTestRun.creation_time.desc()) \
+        .first()
+    if not last_full_run or datetime.utcnow() - last_full_run.creation_time.replace(tzinfo=None) > interval:
+        logger.info('Run all the tests of build %s, the last full test run is older than %s', build_id, interval)
+        return None
+
+    build = DbBuild.query.filter_by(id=build_id).one_or_none()
+    if not build or not build.commit_date:
+        return None
+
+    ancestor = db.session.query(DbBuild.id) \
+        .join(DbTestRun, DbTestRun.build_id == DbBuild.id) \
+        .filter(DbBuild.commit_date < build.commit_date) \
+        .filter(DbTestRun.state == 'completed') \
+        .order_by(DbBuild.commit_date.desc()) \
+        .first()
+    if not ancestor:
+        return None
+
+    modules = get_changed_modules(ancestor.id, build_id)
+    if modules is None:
+        logger.info('Run all the tests of build %s, it changed more than the command modules since %s', build_id,
+                    ancestor.id)
+        return None
+
+    core = {m.strip().upper() for m in get_setting('test_core_modules', DEFAULT_TEST_CORE_MODULES).split(',')}
+    logger.info('Run the tests of %s of build %s, changed since %s', ', '.join(sorted(modules)), build_id,
+                ancestor.id)
+    return modules | {m for m in core if m}
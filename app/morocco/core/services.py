@@ -1,6 +1,9 @@
+import os
+import threading
 import requests
 from collections import namedtuple
-from typing import List, Union
+from datetime import datetime, timedelta
+from typing import Callable, Iterator, List, Union
 
 from azure.batch import BatchServiceClient
 from azure.storage.blob import BlockBlobService
@@ -11,6 +14,15 @@ SourceControlInfo = namedtuple('SourceControlInfo', ['url', 'branch'])
 StorageAccountInfo = namedtuple('StorageAccountInfo', ['account', 'key'])
 AutomationActorInfo = namedtuple('AutomationActorInfo', ['account', 'key', 'tenant'])
 GithubAppInfo = namedtuple('GithubAppInfo', ['id', 'secret'])
+HttpPoolInfo = namedtuple('HttpPoolInfo', ['size', 'keep_alive'])
+
+DEFAULT_HTTP_POOL_SIZE = 10
+DEFAULT_POOL_CACHE_TTL = 300  # in seconds
+
+# the clients shared by all the threads of a process. they're keyed by the process id so that a forked worker creates
+# its own connections, and they're rebuilt when the settings they're created from change.
+_clients = {}  # pylint: disable=invalid-name
+_clients_lock = threading.Lock()  # pylint: disable=invalid-name
 
 
 def get_source_control_info() -> SourceControlInfo:
@@ -18,30 +30,35 @@ def get_source_control_info() -> SourceControlInfo:
 
 
 def get_source_control_commit(sha: str) -> Union[dict, None]:
-    git_url = get_source_control_info().url
-    git_url = git_url.replace('https://github.com', 'https://api.github.com/repos')[:-4] + '/commits/' + sha
+    from morocco.core.github import github_get
+    return github_get(_get_source_control_api_url() + '/commits/' + sha).content
 
-    credential = get_github_app_info()
-    git_url += '?client_id={}&client_secret={}'.format(credential.id, credential.secret)
 
-    response = requests.get(git_url)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        return None
+def get_source_control_comparison(base_sha: str, head_sha: str) -> Union[dict, None]:
+    """Compare two commits, including the files changed between them."""
+    from morocco.core.github import github_get
+    return github_get('{}/compare/{}...{}'.format(_get_source_control_api_url(), base_sha, head_sha)).content
 
 
-def get_source_control_commits(since=None):
-    git_url = get_source_control_info().url
-    git_url = git_url.replace('https://github.com', 'https://api.github.com/repos')[:-4] + '/commits'
-
-    credential = get_github_app_info()
-    git_url += '?client_id={}&client_secret={}'.format(credential.id, credential.secret)
+def iter_source_control_commits(since: str = None, max_pages: int = None) -> Iterator[dict]:
+    """Stream the commits, newest first, following the pagination of the GitHub API."""
+    from morocco.core.github import iter_github_pages
 
+    git_url = _get_source_control_api_url() + '/commits?per_page=100'
     if since:
         git_url += '&since={}'.format(since)
 
-    return requests.get(git_url).json()
+    for page in iter_github_pages(git_url, max_pages):
+        yield from page
+
+
+def get_source_control_commits(since: str = None, max_pages: int = None) -> List[dict]:
+    return list(iter_source_control_commits(since, max_pages))
+
+
+def _get_source_control_api_url() -> str:
+    git_url = get_source_control_info().url
+    return git_url.replace('https://github.com', 'https://api.github.com/repos')[:-4]
 
 
 def get_github_app_info() -> GithubAppInfo:
@@ -60,25 +77,163 @@ def get_batch_account_info() -> BatchAccountInfo:
     return _read_section_from_config(BatchAccountInfo, prefix='BATCH')
 
 
+def get_http_pool_info() -> HttpPoolInfo:
+    return HttpPoolInfo(size=int(get_setting('http_pool_size', DEFAULT_HTTP_POOL_SIZE)),
+                        keep_alive=str(get_setting('http_keep_alive', True)).lower() == 'true')
+
+
 def get_batch_client() -> BatchServiceClient:
-    from azure.batch.batch_auth import SharedKeyCredentials
     account_info = get_batch_account_info()
+    pool_info = get_http_pool_info()
+    return _get_pooled_client('batch', (account_info, pool_info), lambda: _create_batch_client(account_info, pool_info))
+
+
+class PoolDirectory(object):
+    """
+    Index the pools of the batch account by their usage metadata. The index is rebuilt when it is older than the TTL, or
+    on a lookup miss so a newly added pool is found without waiting for the TTL.
+    """
+
+    # a lookup miss doesn't rebuild an index younger than this, so repeated lookups of a missing pool don't list the
+    # pools on every call
+    _MIN_REFRESH_INTERVAL = timedelta(seconds=10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_update = datetime.min
+        self._account = None
+        self._pools = {}
+
+    def get(self, usage: str, ttl: int) -> Union[CloudPool, None]:
+        account = get_batch_account_info().account
+        with self._lock:
+            age = datetime.utcnow() - self._last_update
+            if account != self._account or age >= timedelta(seconds=ttl):
+                self._refresh(account)
+            elif usage not in self._pools and age >= self._MIN_REFRESH_INTERVAL:
+                self._refresh(account)
+
+            return self._pools.get(usage)
 
-    cred = SharedKeyCredentials(account_info.account, account_info.key)
-    return BatchServiceClient(cred, account_info.endpoint)
+    def _refresh(self, account: str) -> None:
+        from azure.batch.models import PoolListOptions
+        from morocco.batch.util import get_metadata
+        from morocco.util import get_logger
+
+        get_logger(PoolDirectory.__name__).info('Refresh the pools of batch account %s', account)
+
+        pools = {}
+        for pool in get_batch_client().pool.list(PoolListOptions(select='id,metadata')):
+            usage = get_metadata(pool.metadata, 'usage')
+            if usage and usage not in pools:
+                pools[usage] = pool
+
+        self._pools = pools
+        self._account = account
+        self._last_update = datetime.utcnow()
+
+
+_pool_directory = PoolDirectory()  # pylint: disable=invalid-name
 
 
 def get_batch_pool(usage: str) -> CloudPool:
-    for pool in get_batch_client().pool.list():
-        if next(m.value for m in pool.metadata if m.name == 'usage') == usage:
-            return pool
+    pool = _pool_directory.get(usage, int(get_setting('pool_cache_ttl', DEFAULT_POOL_CACHE_TTL)))
+    if not pool:
+        raise EnvironmentError('Fail to find a pool.')
 
-    raise EnvironmentError('Fail to find a pool.')
+    return pool
 
 
 def get_blob_storage_client() -> BlockBlobService:
     account_info = get_storage_account_info()
-    return BlockBlobService(account_info.account, account_info.key)
+    pool_info = get_http_pool_info()
+    return _get_pooled_client('storage', (account_info, pool_info), lambda: BlockBlobService(
+        account_info.account, account_info.key,
+        request_session=_create_http_session(pool_info) if pool_info.keep_alive else None))
+
+
+class SasTokenCache(object):
+    """
+    Hand out container SAS tokens which stay valid for at least the requested time. A token is generated with twice the
+    requested validity and reused until less than the requested validity is left, so signing happens once per container
+    and permission every so often instead of once per blob.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = {}
+
+    def get(self, storage: BlockBlobService, container: str, permission, min_validity: timedelta) -> str:
+        key = (storage.account_name, container, str(permission), min_validity)
+        now = datetime.utcnow()
+        with self._lock:
+            token, expiry = self._tokens.get(key, (None, datetime.min))
+            if expiry - now < min_validity:
+                expiry = now + 2 * min_validity
+                token = storage.generate_container_shared_access_signature(container, permission=permission,
+                                                                           expiry=expiry, protocol='https')
+                self._tokens[key] = (token, expiry)
+
+            return token
+
+
+_sas_token_cache = SasTokenCache()  # pylint: disable=invalid-name
+
+
+def get_container_sas(container: str, permission, min_validity: timedelta) -> str:
+    """Return a SAS token of the container, with the given ContainerPermissions, valid for at least min_validity."""
+    return _sas_token_cache.get(get_blob_storage_client(), container, permission, min_validity)
+
+
+def _get_pooled_client(kind: str, settings: tuple, create_client: Callable):
+    key = (kind, os.getpid())
+    with _clients_lock:
+        cached = _clients.get(key)
+        if cached and cached[0] == settings:
+            return cached[1]
+
+        client = create_client()
+        _clients[key] = (settings, client)
+        return client
+
+
+def _create_http_session(pool_info: HttpPoolInfo) -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_info.size, pool_maxsize=pool_info.size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _create_batch_client(account_info: BatchAccountInfo, pool_info: HttpPoolInfo) -> BatchServiceClient:
+    from azure.batch.batch_auth import SharedKeyCredentials
+
+    class _PooledSharedKeyCredentials(SharedKeyCredentials):
+        """Sign every request on the same session so its connections are reused."""
+
+        def __init__(self, account_name: str, key: str):
+            super(_PooledSharedKeyCredentials, self).__init__(account_name, key)
+            self._session = _create_http_session(pool_info)
+            self._session.auth = self.auth
+
+        def signed_session(self, session=None):  # pylint: disable=unused-argument, arguments-differ
+            return self._session
+
+    if pool_info.keep_alive:
+        client = BatchServiceClient(_PooledSharedKeyCredentials(account_info.account, account_info.key),
+                                    account_info.endpoint)
+        client.config.keep_alive = True
+    else:
+        client = BatchServiceClient(SharedKeyCredentials(account_info.account, account_info.key), account_info.endpoint)
+
+    return client
+
+
+def get_setting(name: str, default=None):
+    """Read an optional MOROCCO_<NAME> setting, falling back to the default if it is not configured."""
+    from morocco.main import app
+    value = app.config.get('MOROCCO_{}'.format(name).upper())
+    return default if value is None or value == '' else value
 
 
 def _read_section_from_config(named_tuple_type, prefix: str):
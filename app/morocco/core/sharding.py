@@ -0,0 +1,231 @@
+"""
+Test sharding by the historical test durations
+
+A sharded test job runs its tests in MOROCCO_TEST_SHARD_COUNT tasks instead of one task per test. The tests of the last
+MOROCCO_SCHEDULE_HISTORY_RUNS completed test runs are packed into the shards by their average duration, longest first
+into the least loaded shard, so the shards finish at about the same time. The schedule is uploaded next to the outputs
+of the job and handed to the job manager as schedule.json:
+
+    {"modules": ["<module>", ...], "tests": ["<test full name>", ...],
+     "shards": [{"id": "shard-0", "tests": ["<test full name>", ...], "duration": <estimated seconds>}, ...]}
+
+The modules are set if the tests were selected by morocco.core.selection, and the shards if the job is sharded. A test
+which isn't in any shard, e.g. one added since the history runs, is run by the shards of unknown_test_shards in turn,
+the least loaded first:
+
+    {"unknown_test_shards": ["shard-3", "shard-0", ...]}
+
+Every shard task uploads a results.jsonl next to its stdout.txt, listing the tests it ran one per line:
+
+    {"display_name": "<same as the task of the test>", "exit_code": 0, "duration": <seconds>,
+     "output": "<output of a failed test>"}
+
+which the ingestion streams and expands into one test case per test. The task id of a test is derived from the shard
+and the test full name, not taken from the results, so it is the same on every read. The output is capped at
+MOROCCO_TEST_OUTPUT_MAX_SIZE like the one of a test task.
+
+A shard whose results can't be read, e.g. because the callback came before the upload finished, is left pending and
+read again by a later refresh. Only once the job completed, a shard without its results, e.g. one which crashed, is
+ingested as the failure of each test scheduled into it.
+"""
+
+import heapq
+import json
+import os
+from collections import namedtuple
+from datetime import timedelta
+from typing import Dict, Iterable, List, Set, Tuple, Union
+
+from morocco.batch.util import ExecutionRecord, TaskRecord
+from morocco.util import get_logger
+
+DEFAULT_TEST_SHARD_COUNT = 0  # one task per test
+DEFAULT_SCHEDULE_HISTORY_RUNS = 5
+
+SHARD_TASK_PREFIX = 'shard-'
+SCHEDULE_FILE = 'schedule.json'
+SHARD_RESULTS_FILE = 'results.jsonl'
+
+Shard = namedtuple('Shard', ['id', 'tests', 'duration'])
+
+
+def get_test_durations(history_runs: int, modules: Set[str] = None) -> Dict[str, float]:
+    """
+    The average duration of the tests of the latest completed test runs, by the test full name, optionally of the given
+    modules only.
+    """
+    from sqlalchemy import func
+    from morocco.application import db
+    from morocco.models import DbTestCase, DbTestRun
+
+    runs = db.session.query(DbTestRun.id) \
+        .filter(DbTestRun.state == 'completed') \
+        .order_by(DbTestRun.creation_time.desc()) \
+        .limit(history_runs) \
+        .subquery()
+    rows = db.session.query(DbTestCase.test_full_name, func.avg(DbTestCase.test_duration)) \
+        .filter(DbTestCase.test_run_id.in_(runs))
+    if modules is not None:
+        rows = rows.filter(DbTestCase.module.in_(list(modules)))
+
+    return {name: float(duration or 0) for name, duration in rows.group_by(DbTestCase.test_full_name)}
+
+
+def pack_tests(durations: Dict[str, float], shard_count: int) -> List[Shard]:
+    """Pack the tests into the shards, longest processing time first, each into the shard of the least duration."""
+    shards = [(0.0, index, []) for index in range(shard_count)]
+    heapq.heapify(shards)
+    for name, duration in sorted(durations.items(), key=lambda item: (-item[1], item[0])):
+        load, index, tests = heapq.heappop(shards)
+        tests.append(name)
+        heapq.heappush(shards, (load + duration, index, tests))
+
+    return [Shard('{}{}'.format(SHARD_TASK_PREFIX, index), tests, int(load))
+            for load, index, tests in sorted(shards, key=lambda shard: shard[1])]
+
+
+def create_test_schedule(job_id: str, shard_count: int, modules: Set[str] = None) -> Union[str, None]:
+    """
+    Upload the schedule of the test job. Returns its URL, or None if the job runs every test in its own task, or if
+    there is no history to schedule from.
+    """
+    from azure.storage.blob.models import ContainerPermissions
+    from morocco.core.services import get_blob_storage_client, get_container_sas, get_setting
+
+    if not shard_count and modules is None:
+        return None
+
+    durations = get_test_durations(int(get_setting('schedule_history_runs', DEFAULT_SCHEDULE_HISTORY_RUNS)), modules)
+    if not durations and not modules:
+        return None
+
+    schedule = {'tests': sorted(durations)}
+    if modules is not None:
+        schedule['modules'] = sorted(modules)
+    if shard_count:
+        shards = pack_tests(durations, shard_count)
+        schedule['shards'] = [s._asdict() for s in shards]
+        schedule['unknown_test_shards'] = [s.id for s in sorted(shards, key=lambda shard: shard.duration)]
+        get_logger('sharding').info('Schedule %d tests of job %s in %d shards, the longest takes %d seconds',
+                                    len(durations), job_id, len(shards), max(s.duration for s in shards))
+
+    storage = get_blob_storage_client()
+    blob_name = '{}/{}'.format(job_id, SCHEDULE_FILE)
+    storage.create_blob_from_text('output', blob_name, json.dumps(schedule))
+
+    sas = get_container_sas('output', ContainerPermissions(read=True), timedelta(days=1))
+    return storage.make_blob_url('output', blob_name, sas_token=sas, protocol='https')
+
+
+def is_shard_task(task) -> bool:
+    return task.id.startswith(SHARD_TASK_PREFIX)
+
+
+def expand_shard_tasks(job_id: str, tasks: Iterable, job_completed: bool = False) -> Tuple[List, Dict[str, str], List]:
+    """
+    Replace the shard tasks with records of the tests they ran, streamed from their results.jsonl. Returns the tasks,
+    the outputs of the failed tests by their task id, and the shard tasks whose results can't be read yet.
+
+    If the results of a shard can't be read, nothing of it is ingested until the job completed. Then the tests scheduled
+    into it are recorded as failed, so the rest of the test run is still ingested.
+    """
+    from morocco.core.ingestion import DEFAULT_TEST_OUTPUT_MAX_SIZE
+    from morocco.core.services import get_setting
+
+    logger = get_logger('sharding')
+    max_output_size = int(get_setting('test_output_max_size', DEFAULT_TEST_OUTPUT_MAX_SIZE))
+
+    expanded, outputs, pending, schedule = [], {}, [], None
+    for task in tasks:
+        if not is_shard_task(task):
+            expanded.append(task)
+            continue
+
+        start_time = task.execution_info.start_time or task.execution_info.end_time
+        records, shard_outputs = [], {}
+        try:
+            for result in _read_shard_results(job_id, task.id):
+                test_id = get_shard_test_id(task.id, _get_test_full_name(result['display_name']))
+                end_time = start_time + timedelta(seconds=result.get('duration') or 0)
+                records.append(TaskRecord(test_id, result['display_name'], task.state,
+                                          ExecutionRecord(start_time, end_time, result['exit_code'])))
+                if result['exit_code'] != 0:
+                    # the output of a test in a shard is read from the results, not from the stdout.txt of a test task
+                    shard_outputs[test_id] = _cap_test_output(result.get('output') or '', max_output_size)
+        except Exception:  # pylint: disable=broad-except
+            if not job_completed:
+                # a partial read is dropped as well, the shard is read again as a whole
+                logger.warning('Fail to read the results of shard %s of job %s, read them again later', task.id,
+                               job_id, exc_info=True)
+                pending.append(task)
+                continue
+
+            logger.exception('Fail to read the results of shard %s of completed job %s, record its tests as failed',
+                             task.id, job_id)
+            if schedule is None:
+                schedule = _get_test_schedule(job_id)
+            reported = {r.id for r in records}
+            shard_tests = next((s['tests'] for s in schedule.get('shards', []) if s['id'] == task.id), [])
+            for name in shard_tests:
+                test_id = get_shard_test_id(task.id, name)
+                if test_id in reported:
+                    continue
+                test_class_full, _, test_method = name.rpartition('.')
+                records.append(TaskRecord(test_id, 'test {} ({})'.format(test_method, test_class_full), task.state,
+                                          ExecutionRecord(start_time, start_time, -1)))
+                shard_outputs[test_id] = 'The results of {} are missing, see its stdout.txt for the output of the ' \
+                                         'test.'.format(task.id)
+
+        expanded.extend(records)
+        outputs.update(shard_outputs)
+
+    return expanded, outputs, pending
+
+
+def get_shard_test_id(shard_id: str, test_full_name: str) -> str:
+    """The task id of a test of a shard, the same whether the test is read from the results or from the schedule."""
+    return '{}.{}'.format(shard_id, test_full_name)
+
+
+def _read_shard_results(job_id: str, shard_id: str) -> Iterable[dict]:
+    """Stream the results of the shard, one line at a time, so its file is never held in memory as a whole."""
+    import requests
+    from azure.storage.blob.models import ContainerPermissions
+    from morocco.core.services import get_blob_storage_client, get_container_sas
+
+    storage = get_blob_storage_client()
+    sas = get_container_sas('output', ContainerPermissions(read=True), timedelta(hours=1))
+    url = storage.make_blob_url('output', os.path.join(job_id, shard_id, SHARD_RESULTS_FILE), sas_token=sas,
+                                protocol='https')
+    with requests.get(url, stream=True) as response:
+        if response.status_code != 200:
+            raise ValueError('Fail to read the results of shard {} of job {}: {}'.format(shard_id, job_id,
+                                                                                      response.status_code))
+        for line in response.iter_lines():
+            if line.strip():
+                yield json.loads(line.decode('utf-8'))
+
+
+def _get_test_schedule(job_id: str) -> dict:
+    from morocco.core.services import get_blob_storage_client
+
+    try:
+        blob = get_blob_storage_client().get_blob_to_text('output', '{}/{}'.format(job_id, SCHEDULE_FILE))
+        return json.loads(blob.content)
+    except Exception:  # pylint: disable=broad-except
+        get_logger('sharding').exception('Fail to read the schedule of job %s', job_id)
+        return {}
+
+
+def _get_test_full_name(display_name: str) -> str:
+    """The test full name of the display name of a test task, the same as DbTestCase.test_full_name."""
+    _, test_method, test_class_full = display_name.split(' ')
+    return '{}.{}'.format(test_class_full.strip('()'), test_method)
+
+
+def _cap_test_output(output: str, max_size: int) -> str:
+    from morocco.core.ingestion import TestOutputExtractor
+
+    extractor = TestOutputExtractor(max_size, header=0, footer=0)
+    extractor.feed(output.encode('utf-8'))
+    return extractor.result()
@@ -0,0 +1,234 @@
+"""
+A write-behind log of the webhook events
+
+The webhook handlers append the events and their remarks to a local append-only file which is fsync'ed before the
+handler continues, instead of committing every event to the database. The file is rotated into a segment and flushed to
+the db_webhook_event table in one batch once it holds MOROCCO_EVENT_LOG_BATCH_SIZE events or is older than
+MOROCCO_EVENT_LOG_FLUSH_INTERVAL seconds. The age is checked on every write, and by a timer thread of the process, so
+the events of a process which went idle are flushed as well. The batch is flushed by a background thread, off the
+request path of the handler, and a segment which fails to flush is left for the next flush, e.g. by the idle
+background worker.
+
+Only the database writes of the events are queued. The handlers still do the work of the event, e.g. ingesting a test,
+before they respond.
+
+Every event carries a unique key which is saved with the row. The rows are upserted by the key, so a segment left behind
+by a crash, whether or not it reached the database, can be replayed without duplicating events, and the segments can be
+flushed in any order.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from morocco.util import get_logger
+
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_FLUSH_INTERVAL = 10  # in seconds
+
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class WebhookEventLog(object):
+    def __init__(self, directory: str, batch_size: int, flush_interval: int):
+        self._logger = get_logger(WebhookEventLog.__name__)
+        self._lock = threading.Lock()
+        self._directory = directory
+        self._batch_size = batch_size
+        self._flush_interval = timedelta(seconds=flush_interval)
+        self._path = os.path.join(directory, '{}.log'.format(os.getpid()))
+        self._pending = 0
+        self._last_flush = datetime.utcnow()
+        self._flusher = None
+
+        os.makedirs(directory, exist_ok=True)
+
+        # a log of the same name was left by an earlier process with the same id
+        if os.path.exists(self._path):
+            self._rotate()
+
+        threading.Thread(target=self._flush_periodically, name='event-log-timer', daemon=True).start()
+
+    def append(self, source: str, content: str, signature: str = None, remark: str = None) -> str:
+        """Durably queue an event and return its key."""
+        key = uuid.uuid4().hex
+        self._write({'op': 'event', 'key': key, 'time': datetime.utcnow().strftime(_TIME_FORMAT), 'source': source,
+                     'content': content, 'signature': signature, 'remark': remark}, is_event=True)
+        return key
+
+    def remark(self, key: str, remark: str) -> None:
+        self._write({'op': 'remark', 'key': key, 'remark': remark})
+
+    def flush(self) -> None:
+        """Flush the events appended so far, and the segments which were not flushed, to the database."""
+        with self._lock:
+            if self._pending:
+                self._rotate()
+
+        self.replay()
+
+    def replay(self) -> None:
+        """Flush the rotated segments, and the files left by the processes that are gone, to the database."""
+        for name in sorted(os.listdir(self._directory)):
+            if name.endswith('.segment'):
+                base, owner = name, None
+            elif name.endswith('.log'):
+                base, owner = name, name[:-len('.log')]
+            elif name.endswith('.replaying'):
+                base, owner, _ = name.rsplit('.', 2)
+            else:
+                continue
+
+            if owner and _is_process_alive(owner):
+                continue
+
+            # claim the file by renaming it, so that it is flushed by one process when multiple processes replay
+            claimed = os.path.join(self._directory, '{}.{}.replaying'.format(base, os.getpid()))
+            try:
+                os.rename(os.path.join(self._directory, name), claimed)
+            except OSError:
+                continue
+
+            try:
+                self._flush_file(claimed)
+            except Exception:  # pylint: disable=broad-except
+                # release the claim, so the file is flushed again rather than left to this process while it lives
+                self._logger.exception('Fail to flush %s, it will be flushed again later', name)
+                os.rename(claimed, os.path.join(self._directory, name))
+                continue
+            os.remove(claimed)
+
+    def _write(self, record: dict, is_event: bool = False) -> None:
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            with open(self._path, 'a', encoding='utf-8') as log_file:
+                log_file.write(line)
+                log_file.flush()
+                os.fsync(log_file.fileno())
+
+            if is_event:
+                self._pending += 1
+            if self._pending >= self._batch_size or self._is_due():
+                self._rotate()
+                self._start_flusher()
+
+    def _flush_periodically(self) -> None:
+        """Rotate and flush the log once it is due, even if the process doesn't write anymore."""
+        while True:
+            time.sleep(self._flush_interval.total_seconds())
+            with self._lock:
+                if self._is_due():
+                    self._rotate()
+                    self._start_flusher()
+
+    def _is_due(self) -> bool:
+        """Whether the log holds events older than the flush interval. The caller holds the lock."""
+        return bool(self._pending) and datetime.utcnow() - self._last_flush >= self._flush_interval
+
+    def _start_flusher(self) -> None:
+        """Replay the segments in a background thread, unless one is still running. The caller holds the lock."""
+        if self._flusher and self._flusher.is_alive():
+            return
+
+        self._flusher = threading.Thread(target=self.replay, name='event-log-flusher', daemon=True)
+        self._flusher.start()
+
+    def _rotate(self) -> None:
+        if os.path.exists(self._path):
+            timestamp = datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+            name = '{}-{}-{}.segment'.format(os.getpid(), timestamp, uuid.uuid4().hex)
+            os.rename(self._path, os.path.join(self._directory, name))
+        self._pending = 0
+        self._last_flush = datetime.utcnow()
+
+    def _flush_file(self, path: str) -> None:
+        from sqlalchemy import func, select
+        from morocco.application import db
+        from morocco.models import DbWebhookEvent
+
+        events, remarks = {}, []
+        with open(path, encoding='utf-8') as log_file:
+            for line in log_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line is torn if the process crashed while writing it
+                    continue
+
+                if record['op'] == 'event':
+                    events[record['key']] = record
+                elif record['key'] in events:
+                    events[record['key']]['remark'] = record['remark']
+                else:
+                    remarks.append(record)
+
+        table = DbWebhookEvent.__table__
+        with db.engine.begin() as connection:
+            existing = set()
+            keys = list(events.keys()) + [r['key'] for r in remarks]
+            for start in range(0, len(keys), 500):
+                existing.update(row.event_key for row in connection.execute(
+                    select([table.c.event_key]).where(table.c.event_key.in_(keys[start:start + 500]))))
+
+            rows = [{'event_key': e['key'],
+                     'time': datetime.strptime(e['time'], _TIME_FORMAT),
+                     'source': e['source'],
+                     'content': e['content'],
+                     'signature': e['signature'],
+                     'remark': e['remark']} for e in events.values() if e['key'] not in existing]
+            if rows:
+                connection.execute(table.insert(), rows)
+
+            # the row exists if the segment was flushed before a crash, or if a later remark was flushed first
+            for key in (k for k in events if k in existing):
+                event = events[key]
+                connection.execute(table.update().where(table.c.event_key == key).values(
+                    time=datetime.strptime(event['time'], _TIME_FORMAT),
+                    source=event['source'],
+                    content=event['content'],
+                    signature=event['signature'],
+                    remark=func.coalesce(table.c.remark, event['remark'])))
+
+            # the remarks of the events in other segments
+            for record in remarks:
+                if record['key'] in existing:
+                    connection.execute(table.update().where(table.c.event_key == record['key'])
+                                       .values(remark=record['remark']))
+                else:
+                    connection.execute(table.insert().values(event_key=record['key'], remark=record['remark']))
+                    existing.add(record['key'])
+
+        self._logger.info('Flushed %d events and %d remarks from %s', len(events), len(remarks), path)
+
+
+def _is_process_alive(pid: str) -> bool:
+    try:
+        os.kill(int(pid.split('-')[0]), 0)
+    except ProcessLookupError:
+        return False
+    except (ValueError, OSError):
+        return True
+    return True
+
+
+_event_logs = {}  # pylint: disable=invalid-name
+_event_logs_lock = threading.Lock()  # pylint: disable=invalid-name
+
+
+def get_event_log() -> WebhookEventLog:
+    """Return the event log of the current process."""
+    from morocco.application import app
+    from morocco.core.services import get_setting
+
+    with _event_logs_lock:
+        event_log = _event_logs.get(os.getpid())
+        if not event_log:
+            event_log = WebhookEventLog(get_setting('event_log_dir', os.path.join(app.instance_path, 'events')),
+                                        int(get_setting('event_log_batch_size', DEFAULT_BATCH_SIZE)),
+                                        int(get_setting('event_log_flush_interval', DEFAULT_FLUSH_INTERVAL)))
+            _event_logs[os.getpid()] = event_log
+
+        return event_log
@@ -1,32 +1,77 @@
 # pylint: disable=invalid-name
 
-import os
-from datetime import datetime, timedelta
+from typing import Union
 
-from flask import render_template, request, redirect, url_for
+from flask import render_template, request, redirect, url_for, jsonify
 
-from morocco.batch import get_job, list_tasks
-from morocco.core import get_blob_storage_client
-
-from azure.batch.models import JobState
-from azure.storage.blob.models import BlobPermissions
+from morocco.batch import get_job
 
 from .application import db, app, load_config_from_db
-from .models import DbUser, DbBuild, DbTestRun, DbTestCase, DbWebhookEvent, DbAccessKey
+from .models import DbUser, DbBuild, DbTestRun, DbAccessKey, DbBackgroundJob
 from .view_models import Snapshot
 from .authentication import login_required
+from . import commands  # pylint: disable=unused-import
 
 load_config_from_db()
 
 
+def _get_next_page_url(page) -> Union[str, None]:
+    if not page.next_cursor:
+        return None
+
+    args = request.args.to_dict()
+    args['cursor'] = page.next_cursor
+    return url_for(request.endpoint, **args)
+
+
+def _accepted(job, message: str):
+    """Respond 202 for a queued background job, pointing the client to its status."""
+    from morocco.util import should_return_html
+
+    status_url = url_for('background_job', job_id=job.id)
+    headers = {'Location': status_url}
+    if should_return_html(request):
+        return render_template('message.html', message=message, status_url=status_url, title='Accepted'), 202, headers
+
+    return jsonify(id=job.id, state=job.state, status=status_url), 202, headers
+
+
 @app.route('/builds', methods=['GET'])
 def builds():
+    from morocco.paging import paginate, get_page_size
+    from morocco.util import should_return_html
+
     query = DbBuild.query
-    if request.args.get('include_suppressed') != 'true':
+    if request.args.get('suppressed'):
+        query = query.filter_by(suppressed=request.args['suppressed'] == 'true')
+    elif request.args.get('include_suppressed') != 'true':
         query = query.filter_by(suppressed=False)
 
-    view_models = (Snapshot(b) for b in query.order_by(DbBuild.commit_date.desc()).all())
-    return render_template('builds.html', models=view_models, title='Snapshots')
+    if request.args.get('state'):
+        query = query.filter_by(state=request.args['state'])
+
+    try:
+        page = paginate(query, DbBuild.commit_date, DbBuild.id, request.args.get('cursor'),
+                        get_page_size(request.args.get('page_size')))
+    except ValueError as ex:
+        return str(ex), 400
+
+    view_models = Snapshot.load(page.items)
+    next_url = _get_next_page_url(page)
+
+    if not should_return_html(request):
+        return jsonify(builds=[{'id': s.id,
+                                'state': s.state,
+                                'suppressed': s.suppressed,
+                                'commit_author': s.commit_author,
+                                'commit_message': s.commit_message,
+                                'commit_date': s.data.commit_date.isoformat() if s.data.commit_date else None,
+                                'commit_url': s.commit_url,
+                                'build_download_url': s.build_download_url,
+                                'live_test_pass_rate': s.live_test_pass_rate} for s in view_models],
+                       next=next_url)
+
+    return render_template('builds.html', models=view_models, next_url=next_url, title='Snapshots')
 
 
 @app.route('/build/<string:sha>', methods=['GET'])
@@ -38,17 +83,12 @@ def build(sha: str):
 @app.route('/builds', methods=['POST'])
 @login_required
 def sync_builds():
-    from morocco.core import get_source_control_commits, sync_build
+    from morocco.background import enqueue
     from flask_login import current_user
     if not current_user.is_authenticated or not current_user.is_admin():
         return 'Forbidden', 403
 
-    build_commits = get_source_control_commits()
-
-    for commit in build_commits:
-        sync_build(commit=commit, create_job=True)
-
-    return redirect(url_for('builds'))
+    return _accepted(enqueue('sync_builds'), 'Builds are being synced.')
 
 
 @app.route('/build/<string:sha>', methods=['POST'])
@@ -57,7 +97,7 @@ def post_build(sha: str):
     action = request.form.get('action')
     if action == 'refresh' or action == 'rebuild':
         from morocco.core import sync_build
-        sync_build(sha=sha, create_job=(action == 'rebuild'))
+        sync_build(sha=sha, create_job=(action == 'rebuild'), rebuild=(action == 'rebuild'))
     elif action == 'suppress':
         build_record = DbBuild.query.filter_by(id=sha).one_or_none()
         if not build_record:
@@ -75,8 +115,37 @@ def post_build(sha: str):
 
 @app.route('/tests', methods=['GET'])
 def tests():
-    return render_template('tests.html', test_runs=DbTestRun.query.order_by(DbTestRun.creation_time.desc()).all(),
-                           title='Test Runs')
+    from morocco.paging import paginate, get_page_size
+    from morocco.util import should_return_html
+
+    query = DbTestRun.query
+    if request.args.get('live'):
+        query = query.filter_by(live=request.args['live'] == 'true')
+
+    if request.args.get('state'):
+        query = query.filter_by(state=request.args['state'])
+
+    try:
+        page = paginate(query, DbTestRun.creation_time, DbTestRun.id, request.args.get('cursor'),
+                        get_page_size(request.args.get('page_size')))
+    except ValueError as ex:
+        return str(ex), 400
+
+    next_url = _get_next_page_url(page)
+
+    if not should_return_html(request):
+        return jsonify(tests=[{'id': r.id,
+                               'creation_time': r.creation_time.isoformat() if r.creation_time else None,
+                               'live': r.live,
+                               'state': r.state,
+                               'build_id': r.build_id,
+                               'total_tests': r.total_tests,
+                               'passed_tests': r.passed_tests,
+                               'failed_tests': r.failed_tests,
+                               'total_duration': r.total_duration} for r in page.items],
+                       next=next_url)
+
+    return render_template('tests.html', test_runs=page.items, next_url=next_url, title='Test Runs')
 
 
 @app.route('/test/<string:job_id>', methods=['GET'])
@@ -103,45 +172,51 @@ def post_test():
 @app.route('/test/<string:job_id>', methods=['POST'])
 @login_required
 def refresh_test(job_id: str):
-    import requests
-    storage = get_blob_storage_client()
+    from morocco.background import enqueue
 
     test_run = DbTestRun.query.filter_by(id=job_id).first()
     if not test_run:
         return "Test run job not found", 404
 
-    test_run_job = get_job(job_id)
-    test_run.state = test_run_job.state.value
-
-    if test_run_job.state == JobState.completed:
-        for task in list_tasks(job_id):
-            if task.id == 'test-creator':
-                continue
+    return _accepted(enqueue('refresh_test', job_id=job_id), 'Test run {} is being refreshed.'.format(job_id))
 
-            test_case = DbTestCase.query.filter_by(id=DbTestCase.get_full_name(task, test_run)).one_or_none()
-            if test_case:
-                continue
 
-            test_case = DbTestCase(task, test_run)
+@app.route('/analytics/regressions', methods=['GET'])
+def duration_regressions():
+    """List the tests whose duration regressed from the base build to the head build."""
+    from morocco.core.analytics import get_duration_regressions, DEFAULT_REGRESSION_RATIO, DEFAULT_REGRESSION_MIN_DELTA
 
-            if not test_case.passed:
-                # only load output of failed tests for performance reason
-                container_name = 'output'
-                blob_name = os.path.join(job_id, task.id, 'stdout.txt')
-                sas = storage.generate_blob_shared_access_signature(container_name, blob_name,
-                                                                    permission=BlobPermissions(read=True),
-                                                                    protocol='https',
-                                                                    expiry=(datetime.utcnow() + timedelta(hours=1)))
-                url = storage.make_blob_url(container_name, blob_name, sas_token=sas, protocol='https')
+    base, head = request.args.get('base'), request.args.get('head')
+    if not base or not head:
+        return 'Missing base or head build', 400
 
-                response = requests.request('GET', url)
-                test_case.output = '\n'.join(response.text.split('\n')[58:-3])
+    try:
+        ratio = float(request.args.get('ratio', DEFAULT_REGRESSION_RATIO))
+        min_delta = int(request.args.get('min_delta', DEFAULT_REGRESSION_MIN_DELTA))
+    except ValueError:
+        return 'Invalid ratio or min_delta', 400
 
-            db.session.add(test_case)
+    return jsonify(base=base, head=head,
+                   regressions=[r._asdict() for r in get_duration_regressions(base, head, ratio, min_delta)])
 
-    db.session.commit()
 
-    return redirect(url_for('test', job_id=job_id))
+@app.route('/background/<int:job_id>', methods=['GET'])
+@login_required
+def background_job(job_id: int):
+    job = DbBackgroundJob.query.filter_by(id=job_id).one_or_none()
+    if not job:
+        return 'Background job not found', 404
+
+    return jsonify(id=job.id,
+                   kind=job.kind,
+                   state=job.state,
+                   progress=job.progress,
+                   total=job.total,
+                   message=job.message,
+                   creation_time=job.creation_time.isoformat() if job.creation_time else None,
+                   start_time=job.start_time.isoformat() if job.start_time else None,
+                   end_time=job.end_time.isoformat() if job.end_time else None,
+                   heartbeat_time=job.heartbeat_time.isoformat() if job.heartbeat_time else None)
 
 
 @app.route('/delete_test_run', methods=['POST'])
@@ -199,48 +274,47 @@ def post_access_key():
 def post_api_build():
     from morocco.auth.util import validate_github_webhook
     from morocco.core.operations import on_github_push, on_batch_callback
+    from morocco.eventlog import get_event_log
+
+    event_log = get_event_log()
 
     if request.headers.get('X-GitHub-Event') == 'push':
         # to validate it in the future
-        event = DbWebhookEvent(source='github', content=request.data.decode('utf-8'),
-                               signature=request.headers.get('X-Hub-Signature'))
-        db.session.add(event)
-        db.session.commit()
+        event = event_log.append(source='github', content=request.data.decode('utf-8'),
+                                 signature=request.headers.get('X-Hub-Signature'))
 
         client_id = request.args.get('client_id')
         if not client_id:
-            event.remark = 'missing client id'
-            db.session.commit()
+            event_log.remark(event, 'missing client id')
             return 'Forbidden', 401
 
         key = DbAccessKey.query.filter_by(name=client_id).one_or_none()
         if not key:
             # unknown client
-            event.remark = 'access key not found in db'
-            db.session.commit()
+            event_log.remark(event, 'access key not found in db')
             return 'Forbidden', 401
 
         if not validate_github_webhook(request, key.key1):
-            event.remark = 'github signature invalidate'
-            db.session.commit()
+            event_log.remark(event, 'github signature invalidate')
             return 'Invalid request', 403
 
-        msg = on_github_push(request.json)
+        try:
+            msg = on_github_push(request.json)
+        except ValueError as ex:
+            # the commits were listed in part, the push is synced again by the next push or the sync_builds job
+            event_log.remark(event, 'failed: {}'.format(ex))
+            return str(ex), 502
 
-        event.remark = 'success: {}'.format(msg)
-        db.session.commit()
+        event_log.remark(event, 'success: {}'.format(msg))
 
         return msg, 200
     elif request.headers.get('X-Batch-Event') == 'build.finished':
-        event = DbWebhookEvent(source='batch', content=request.data.decode('utf-8'))
-        db.session.add(event)
-        db.session.commit()
+        event = event_log.append(source='batch', content=request.data.decode('utf-8'))
 
         # the callback's credential is validated in on_batch_callback
         msg, status = on_batch_callback(request, DbBuild)
 
-        event.remark = 'Result: {} -> {}'.format(msg, status)
-        db.session.commit()
+        event_log.remark(event, 'Result: {} -> {}'.format(msg, status))
 
         return msg, status
 
@@ -249,13 +323,11 @@ def post_api_build():
 
 @app.route('/api/hook', methods=['POST'])
 def api_hook():
-    import requests
-    from morocco.core import get_batch_client, get_blob_storage_client
+    from morocco.core import get_batch_client, ingest_test_tasks
+    from morocco.eventlog import get_event_log
 
     if request.headers.get('X-Batch-Event') == 'test.finished':
-        event = DbWebhookEvent(source='batch', content=request.data.decode('utf-8'))
-        db.session.add(event)
-        db.session.commit()
+        get_event_log().append(source='batch', content=request.data.decode('utf-8'))
 
         job_id = request.form.get('job_id')
         task_id = request.form.get('task_id')
@@ -264,24 +336,7 @@ def api_hook():
         test_run = DbTestRun.query.filter_by(id=job_id).first()
         test_run.state = test_run_job.state.value
 
-        task = get_batch_client().task.get(job_id, task_id)
-        test_case = DbTestCase(task, test_run)
-
-        storage = get_blob_storage_client()
-        if not test_case.passed:
-            # only load output of failed tests for performance reason
-            container_name = 'output'
-            blob_name = os.path.join(job_id, task.id, 'stdout.txt')
-            sas = storage.generate_blob_shared_access_signature(container_name, blob_name,
-                                                                permission=BlobPermissions(read=True),
-                                                                protocol='https',
-                                                                expiry=(datetime.utcnow() + timedelta(hours=1)))
-            url = storage.make_blob_url(container_name, blob_name, sas_token=sas, protocol='https')
-
-            response = requests.request('GET', url)
-            test_case.output = '\n'.join(response.text.split('\n')[58:-3])
-
-        db.session.add(test_case)
+        ingest_test_tasks(test_run, [get_batch_client().task.get(job_id, task_id)])
         db.session.commit()
 
         return 'Update {} {}'.format(job_id, task_id), 200
@@ -1,5 +1,5 @@
 import os
-from typing import Union
+from typing import Iterable, List, Union
 
 from flask_login import UserMixin
 
@@ -23,6 +23,8 @@ class DbUser(db.Model, UserMixin):
 
 
 class DbBuild(db.Model):
+    __table_args__ = (db.Index('ix_db_build_commit_date_id', 'commit_date', 'id'),)
+
     id = db.Column(db.String, primary_key=True)
     creation_time = db.Column(db.DateTime)
     state = db.Column(db.String)
@@ -32,6 +34,8 @@ class DbBuild(db.Model):
     commit_message = db.Column(db.String)
     commit_date = db.Column(db.DateTime)
     commit_url = db.Column(db.String)
+    # the hash of the source tree of the commit, the commits of the same tree share one build artifact
+    tree_sha = db.Column(db.String, index=True)
     build_download_url = db.Column(db.String)
     suppressed = db.Column(db.Boolean)
 
@@ -54,16 +58,30 @@ class DbBuild(db.Model):
         self.commit_date = datetime.strptime(commit['commit']['committer']['date'], '%Y-%m-%dT%H:%M:%SZ')
         self.commit_message = commit['commit']['message']
         self.commit_url = commit['html_url']
+        self.tree_sha = commit['commit'].get('tree', {}).get('sha')
 
     def __repr__(self):
         return '<Build {}>'.format(self.id)
 
 
 class DbTestRun(db.Model):
+    __table_args__ = (db.Index('ix_db_test_run_creation_time_id', 'creation_time', 'id'),
+                      db.Index('ix_db_test_run_build_id_live_creation_time', 'build_id', 'live', 'creation_time'))
+
     id = db.Column(db.String, primary_key=True)
     creation_time = db.Column(db.DateTime)
     live = db.Column(db.Boolean)
     state = db.Column(db.String)
+    # the comma separated modules whose tests were selected, see morocco.core.selection. None for a full test run.
+    selection = db.Column(db.String)
+
+    # aggregated results of the test cases, maintained by record_test_cases so list pages don't count the test cases
+    total_tests = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    passed_tests = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    failed_tests = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    total_duration = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # in seconds
+    # the latest end time of the tasks ingested by refresh_test_run, the next refresh lists the tasks completed after it
+    last_task_end_time = db.Column(db.DateTime)
 
     build_id = db.Column(db.String, db.ForeignKey('db_build.id'))
     test_cases = db.relationship('DbTestCase', backref='test_run', lazy='dynamic', cascade='delete')
@@ -75,37 +93,83 @@ class DbTestRun(db.Model):
         self.creation_time = job.creation_time
         self.build_id = get_metadata(job.metadata, 'build')
         self.live = get_metadata(job.metadata, 'live') == 'True'
+        self.selection = get_metadata(job.metadata, 'modules')
         self.state = job.state.value
+        self.total_tests = 0
+        self.passed_tests = 0
+        self.failed_tests = 0
+        self.total_duration = 0
 
     def __repr__(self):
         return '<TestRun {}>'.format(self.id)
 
-    def get_pass_percentage(self) -> Union[int, None]:
-        if not hasattr(self, '_pass_percentage'):
-            all_tests = list(self.test_cases)
-            total = len(all_tests)
-            failed = len([t for t in all_tests if not t.passed])
+    def get_selected_modules(self) -> List[str]:
+        return self.selection.split(',') if self.selection else []
 
-            setattr(self, '_pass_percentage', int((total - failed) * 100 / total) if total else 0)
+    @staticmethod
+    def get_flake_rates(test_cases: Iterable['DbTestCase']) -> dict:
+        """The flake rates of the tests of the test cases, by the test full name."""
+        names = list({t.test_full_name for t in test_cases})
+        if not names:
+            return {}
+        return {h.test_full_name: h.get_flake_rate()
+                for h in DbTestHistory.query.filter(DbTestHistory.test_full_name.in_(names))}
 
-        return getattr(self, '_pass_percentage')
+    def get_pass_percentage(self) -> Union[int, None]:
+        return int(self.passed_tests * 100 / self.total_tests) if self.total_tests else 0
 
     def get_view(self):
         return self.view_type(self.id, str(self.creation_time), self.state, self.total_tests, self.failed_tests)
 
-    @property
-    def total_tests(self):
-        return len(list(self.test_cases))
-
-    @property
-    def failed_tests(self):
-        return len(list(t for t in self.test_cases if not t.passed))
+    def get_failed_test_cases(self, with_output: bool = False) -> List['DbTestCase']:
+        """The failed test cases of the final attempts of the tests, the same ones failed_tests counts."""
+        retry = db.aliased(DbTestCase)
+        later_attempt = db.session.query(retry.id).filter(retry.test_run_id == self.id,
+                                                          retry.test_full_name == DbTestCase.test_full_name,
+                                                          retry.attempt > DbTestCase.attempt)
+        query = self.test_cases.filter(DbTestCase.passed.isnot(True)) \
+            .filter(~later_attempt.exists()) \
+            .order_by(DbTestCase.id)
+        if with_output:
+            query = query.options(db.joinedload('output_record'))
+        return query.all()
+
+    def record_test_cases(self, test_cases: Iterable['DbTestCase']) -> None:
+        """
+        Add the results of newly inserted test cases to the aggregated counters.
+
+        The counters are incremented by a single UPDATE statement in the database instead of read-modify-write in
+        Python, so concurrent callbacks of the same test run don't overwrite each other's results. A test is counted
+        once, by its final attempt: only failed tests are retried, so a passed retry turns a failure into a pass and a
+        failed one changes nothing.
+        """
+        total, passed, failed, duration = 0, 0, 0, 0
+        for test_case in test_cases:
+            duration += test_case.test_duration or 0
+            if test_case.attempt:
+                passed += 1 if test_case.passed else 0
+                failed -= 1 if test_case.passed else 0
+                continue
+            total += 1
+            passed += 1 if test_case.passed else 0
+            failed += 0 if test_case.passed else 1
+
+        if not total and not passed and not duration:
+            return
+
+        DbTestRun.query.filter_by(id=self.id).update({
+            DbTestRun.total_tests: DbTestRun.total_tests + total,
+            DbTestRun.passed_tests: DbTestRun.passed_tests + passed,
+            DbTestRun.failed_tests: DbTestRun.failed_tests + failed,
+            DbTestRun.total_duration: DbTestRun.total_duration + duration}, synchronize_session=False)
+        db.session.expire(self, ['total_tests', 'passed_tests', 'failed_tests', 'total_duration'])
 
 
 class DbTestCase(db.Model):  # pylint: disable=too-many-instance-attributes, too-few-public-methods
     id = db.Column(db.String, primary_key=True)
     passed = db.Column(db.Boolean)
-    output = db.Column(db.String)
+    output_record = db.relationship('DbTestOutput', uselist=False, cascade='all, delete-orphan')
+    output_archive = db.Column(db.String)  # the archive blob the output was moved to, see morocco.retention
     test_run_id = db.Column(db.String, db.ForeignKey('db_test_run.id'))
     module = db.Column(db.String)
     state = db.Column(db.String)
@@ -113,12 +177,18 @@ class DbTestCase(db.Model):  # pylint: disable=too-many-instance-attributes, too
     test_class = db.Column(db.String)
     test_full_name = db.Column(db.String)
     test_duration = db.Column(db.Integer)  # in seconds
+    attempt = db.Column(db.Integer, server_default='0', nullable=False)  # 0 for the first run, n for the nth retry
 
     def __init__(self, test_task: CloudTask, db_test_run: DbTestRun):
-        self.test_run = db_test_run
+        from morocco.core.flakiness import get_attempt
+
+        # assign the foreign key rather than the relationship so the test case isn't cascaded into the session, which
+        # lets the ingestion bulk insert it
+        self.test_run_id = db_test_run.id
 
         self.id = self.get_full_name(test_task, db_test_run)
         self.passed = test_task.execution_info.exit_code == 0
+        self.attempt = get_attempt(test_task.id)
 
         _, self.test_method, test_class_full = test_task.display_name.split(' ')
         self.test_class_full = test_class_full.strip('()')
@@ -142,6 +212,80 @@ class DbTestCase(db.Model):  # pylint: disable=too-many-instance-attributes, too
     def get_full_name(test_task: CloudTask, db_test_run: DbTestRun):
         return db_test_run.id + '.' + test_task.id
 
+    @property
+    def output(self) -> Union[str, None]:
+        """The output of a failed test. It is loaded from db_test_output only when it is accessed."""
+        return self.output_record.text if self.output_record else None
+
+    @output.setter
+    def output(self, value: Union[str, None]) -> None:
+        self.output_record = DbTestOutput(self.id, value) if value is not None else None
+
+
+class DbTestOutput(db.Model):
+    """The zlib compressed output of a test case, stored out of the db_test_case rows."""
+    test_case_id = db.Column(db.String, db.ForeignKey('db_test_case.id'), primary_key=True)
+    content = db.Column(db.LargeBinary)
+
+    def __init__(self, test_case_id: str, text: str):
+        self.test_case_id = test_case_id
+        self.text = text
+
+    @property
+    def text(self) -> str:
+        import zlib
+        return zlib.decompress(self.content).decode('utf-8')
+
+    @text.setter
+    def text(self, value: str) -> None:
+        import zlib
+        self.content = zlib.compress(value.encode('utf-8'))
+
+
+class DbTestHistory(db.Model):
+    """The rolling window of the latest outcomes of a test across the test runs, see morocco.core.flakiness."""
+    test_full_name = db.Column(db.String, primary_key=True)
+    outcomes = db.Column(db.String)  # P for passed and F for failed, the latest last
+    last_test_run_id = db.Column(db.String)
+
+    def __init__(self, test_full_name: str):
+        self.test_full_name = test_full_name
+        self.outcomes = ''
+
+    def get_flake_rate(self) -> float:
+        """
+        The share of the consecutive outcomes which differ. A test which flips between passing and failing is flaky, one
+        which keeps failing is broken.
+        """
+        if len(self.outcomes) < 2:
+            return 0.0
+        flips = sum(1 for a, b in zip(self.outcomes, self.outcomes[1:]) if a != b)
+        return flips / (len(self.outcomes) - 1)
+
+
+class DbTestDuration(db.Model):
+    """The durations of the latest passed runs of a test and their percentiles, see morocco.core.analytics."""
+    test_full_name = db.Column(db.String, primary_key=True)
+    durations = db.Column(db.String)  # comma separated seconds, the latest last
+    p50 = db.Column(db.Integer)
+    p95 = db.Column(db.Integer)
+
+    def __init__(self, test_full_name: str):
+        self.test_full_name = test_full_name
+        self.durations = ''
+
+    def get_durations(self) -> List[int]:
+        return [int(d) for d in self.durations.split(',')] if self.durations else []
+
+
+class DbBuildTestDuration(db.Model):
+    """The total duration of the passed runs of a test in the test runs of a build, see morocco.core.analytics."""
+    build_id = db.Column(db.String, primary_key=True)
+    test_full_name = db.Column(db.String, primary_key=True)
+    module = db.Column(db.String)
+    total_duration = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # in seconds
+    runs = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
 
 class DbProjectSetting(db.Model):
     __tablename__ = 'db_projectsetting'
@@ -173,11 +317,13 @@ class DbAccessKey(db.Model):
 
 class DbWebhookEvent(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    time = db.Column(db.DateTime)
+    event_key = db.Column(db.String, index=True, unique=True)  # assigned by the write-behind log, see morocco.eventlog
+    time = db.Column(db.DateTime, index=True)
     source = db.Column(db.String)
     content = db.Column(db.String)
     signature = db.Column(db.String)
     remark = db.Column(db.String)
+    archive = db.Column(db.String)  # the archive blob the content was moved to, see morocco.retention
 
     def __init__(self, source: str, content: str, signature: str = None, remark: str = None):
         from datetime import datetime
@@ -186,3 +332,40 @@ class DbWebhookEvent(db.Model):
         self.content = content
         self.signature = signature
         self.remark = remark
+
+
+class DbBackgroundJob(db.Model):  # pylint: disable=too-many-instance-attributes, too-few-public-methods
+    """A unit of work queued by a web request and executed by a `flask worker` process."""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String)
+    payload = db.Column(db.String)  # json encoded arguments of the handler
+    state = db.Column(db.String, index=True)  # queued, running, succeeded or failed
+    progress = db.Column(db.Integer)
+    total = db.Column(db.Integer)
+    message = db.Column(db.String)
+    worker = db.Column(db.String)
+    creation_time = db.Column(db.DateTime)
+    start_time = db.Column(db.DateTime)
+    end_time = db.Column(db.DateTime)
+    heartbeat_time = db.Column(db.DateTime)  # the lease of a running job, renewed by its worker
+
+    def __init__(self, kind: str, payload: str):
+        from datetime import datetime
+        self.kind = kind
+        self.payload = payload
+        self.state = 'queued'
+        self.progress = 0
+        self.creation_time = datetime.utcnow()
+
+    def __repr__(self):
+        return '<BackgroundJob {}: {} {}>'.format(self.id, self.kind, self.state)
+
+
+class DbHttpCache(db.Model):
+    """The last response of a cached GET request, see morocco.core.github."""
+    url = db.Column(db.String, primary_key=True)
+    etag = db.Column(db.String)
+    last_modified = db.Column(db.String)
+    next_url = db.Column(db.String)
+    content = db.Column(db.String)
+    time = db.Column(db.DateTime)
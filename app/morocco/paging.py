@@ -0,0 +1,61 @@
+"""
+Keyset (cursor based) pagination over a (time, id) ordering
+
+A page is selected by comparing against the last row of the previous page instead of skipping rows with OFFSET, so the
+cost of a page doesn't depend on how deep it is. Rows are ordered by time, then by id, both descending, which is the
+backward scan of an ascending (time, id) index. As in that scan, the rows of NULL time come first.
+"""
+
+import base64
+import json
+from collections import namedtuple
+from datetime import datetime
+from typing import Tuple, Union
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(time: Union[datetime, None], key: str) -> str:
+    value = json.dumps([time.strftime(_TIME_FORMAT) if time else None, key])
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(cursor: str) -> Tuple[Union[datetime, None], str]:
+    try:
+        time, key = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8'))
+        return datetime.strptime(time, _TIME_FORMAT) if time else None, key
+    except (ValueError, TypeError) as ex:
+        raise ValueError('Invalid cursor {}'.format(cursor)) from ex
+
+
+def get_page_size(value: Union[str, None]) -> int:
+    try:
+        return max(1, min(int(value), MAX_PAGE_SIZE)) if value else DEFAULT_PAGE_SIZE
+    except ValueError:
+        raise ValueError('Invalid page size {}'.format(value))
+
+
+def paginate(query, time_column, id_column, cursor: Union[str, None], page_size: int) -> Page:
+    from sqlalchemy import and_, or_, tuple_
+
+    if cursor:
+        time, key = decode_cursor(cursor)
+        if time:
+            # the rows of NULL time were on the previous pages
+            query = query.filter(tuple_(time_column, id_column) < tuple_(time, key))
+        else:
+            query = query.filter(or_(and_(time_column.is_(None), id_column < key), time_column.isnot(None)))
+
+    # fetch one more row to find out if there is a next page
+    items = query.order_by(time_column.desc(), id_column.desc()).limit(page_size + 1).all()
+    if len(items) <= page_size:
+        return Page(items, None)
+
+    items = items[:page_size]
+    last = items[-1]
+    return Page(items, encode_cursor(getattr(last, time_column.key), getattr(last, id_column.key)))
@@ -0,0 +1,156 @@
+"""
+A poller which reconciles the builds and the test runs with their Batch jobs
+
+The state of the builds and the test runs is otherwise updated by the callbacks the jobs send to /api/build and
+/api/hook, and a lost callback leaves it stale. `flask poller` lists the jobs whose state changed since its previous
+cycle every MOROCCO_POLL_INTERVAL seconds, which takes a few paged job.list calls however many jobs there are, and syncs
+the builds and test runs of those jobs. The first cycle looks back MOROCCO_POLL_LOOKBACK seconds.
+"""
+
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator
+
+from azure.batch.models import CloudJob
+
+from morocco.util import get_logger
+
+DEFAULT_POLL_INTERVAL = 60  # in seconds
+DEFAULT_POLL_LOOKBACK = 24 * 60 * 60  # in seconds
+
+# the state transitions this long before the previous cycle are listed again, in case they are listed late
+_STATE_TRANSITION_OVERLAP = timedelta(minutes=1)
+_CHUNK_SIZE = 500
+
+PollResult = namedtuple('PollResult', ['jobs', 'builds', 'test_runs'])
+
+
+def list_changed_jobs(since: datetime) -> Iterator[CloudJob]:
+    """List the jobs whose state changed after the given time, with only the properties the reconciliation needs."""
+    from azure.batch.models import JobListOptions
+    from morocco.core import get_batch_client
+
+    options = JobListOptions(filter="stateTransitionTime gt DateTime'{}'".format(since.strftime('%Y-%m-%dT%H:%M:%SZ')),
+                             select='id,state,creationTime,metadata')
+    return get_batch_client().job.list(options)
+
+
+def reconcile_jobs(jobs: Iterable[CloudJob]) -> PollResult:
+    """Sync the builds and the test runs of the given jobs. Returns the number of jobs, builds and test runs synced."""
+    from morocco.batch import get_metadata
+
+    jobs = list(jobs)
+    build_jobs = [j for j in jobs if get_metadata(j.metadata, 'usage') == 'build']
+    test_jobs = [j for j in jobs if get_metadata(j.metadata, 'usage') == 'test']
+
+    builds, test_runs = 0, 0
+    for start in range(0, max(len(build_jobs), len(test_jobs)), _CHUNK_SIZE):
+        builds += _reconcile_builds(build_jobs[start:start + _CHUNK_SIZE])
+        test_runs += _reconcile_test_runs(test_jobs[start:start + _CHUNK_SIZE])
+
+    return PollResult(len(jobs), builds, test_runs)
+
+
+def poll(since: datetime) -> PollResult:
+    return reconcile_jobs(list_changed_jobs(since))
+
+
+def run_poller(interval: float = None, once: bool = False) -> None:
+    """Poll the jobs every interval seconds, which defaults to MOROCCO_POLL_INTERVAL."""
+    from morocco.core.services import get_setting
+
+    logger = get_logger('poller')
+    interval = float(interval or get_setting('poll_interval', DEFAULT_POLL_INTERVAL))
+    last_poll = datetime.utcnow() - timedelta(seconds=int(get_setting('poll_lookback', DEFAULT_POLL_LOOKBACK)))
+
+    while True:
+        start = datetime.utcnow()
+        try:
+            result = poll(last_poll - _STATE_TRANSITION_OVERLAP)
+            logger.info('Polled %d jobs, synced %d builds and %d test runs', *result)
+            last_poll = start
+        except Exception:  # pylint: disable=broad-except
+            # the jobs are polled again from the same time in the next cycle
+            logger.exception('Fail to poll the jobs')
+
+        if once:
+            return
+
+        time.sleep(max(0.0, interval - (datetime.utcnow() - start).total_seconds()))
+
+
+def _reconcile_builds(jobs: Iterable[CloudJob]) -> int:
+    from azure.batch.models import JobState, TaskGetOptions
+    from morocco.application import db
+    from morocco.core import get_batch_client, update_build_download_url
+    from morocco.core.operations import share_build_artifact
+    from morocco.models import DbBuild
+
+    # the build task is looked up once its job completed, the state of a running build is left to the callbacks
+    completed = [j.id for j in jobs if j.state == JobState.completed]
+    if not completed:
+        return 0
+
+    count = 0
+    for build_record in DbBuild.query.filter(DbBuild.id.in_(completed)).all():
+        if build_record.state == 'completed' and build_record.build_download_url:
+            continue
+
+        try:
+            build_task = get_batch_client().task.get(build_record.id, 'build', TaskGetOptions(select='id,state'))
+            build_record.state = build_task.state.value
+            update_build_download_url(build_record)
+            db.session.commit()
+            # the callback which shares the artifact with the builds of the same source tree may be lost, too
+            share_build_artifact(build_record.id)
+            count += 1
+        except Exception:  # pylint: disable=broad-except
+            get_logger('poller').exception('Fail to sync build %s', build_record.id)
+            db.session.rollback()
+
+    return count
+
+
+def _reconcile_test_runs(jobs: Iterable[CloudJob]) -> int:
+    from azure.batch.models import JobState
+    from morocco.application import db
+    from morocco.batch import get_metadata
+    from morocco.core import refresh_test_run
+    from morocco.models import DbBuild, DbTestRun
+
+    jobs = {j.id: j for j in jobs}
+    if not jobs:
+        return 0
+
+    test_runs = {t.id: t for t in DbTestRun.query.filter(DbTestRun.id.in_(list(jobs))).all()}
+
+    # the test run is created by post_test right after the job, so it is missing only if the job was created outside
+    # of it, e.g. by hand in Batch, or if the request failed between creating the job and committing the test run
+    missing = [j for j in jobs.values() if j.id not in test_runs]
+    build_ids = {get_metadata(j.metadata, 'build') for j in missing}
+    builds = {row.id for row in db.session.query(DbBuild.id).filter(DbBuild.id.in_(list(build_ids)))} \
+        if build_ids else set()
+    for job in (j for j in missing if get_metadata(j.metadata, 'build') in builds):
+        test_runs[job.id] = DbTestRun(job)
+        db.session.add(test_runs[job.id])
+    db.session.commit()
+
+    count = 0
+    for job_id, test_run in test_runs.items():
+        job = jobs[job_id]
+        try:
+            if job.state == JobState.completed:
+                # only the tasks completed since the last refresh are ingested
+                refresh_test_run(job_id, job=job)
+            elif test_run.state != job.state.value:
+                test_run.state = job.state.value
+                db.session.commit()
+            else:
+                continue
+            count += 1
+        except Exception:  # pylint: disable=broad-except
+            get_logger('poller').exception('Fail to sync test run %s', job_id)
+            db.session.rollback()
+
+    return count
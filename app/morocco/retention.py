@@ -0,0 +1,111 @@
+"""
+Retention of the webhook event payloads and the failed test outputs
+
+The payloads older than MOROCCO_RETENTION_DAYS are moved out of the database into gzip compressed JSON lines blobs in
+the archive container. The rows are kept, with the payload replaced by the name of the blob it was moved to.
+"""
+
+import gzip
+import json
+from datetime import datetime, timedelta
+from typing import Iterator, List
+
+from morocco.util import get_logger
+
+DEFAULT_RETENTION_DAYS = 90
+ARCHIVE_CONTAINER = 'archive'
+
+_BATCH_SIZE = 1000
+
+
+def get_retention_cutoff(days: int = None) -> datetime:
+    from morocco.core.services import get_setting
+
+    if days is None:
+        days = int(get_setting('retention_days', DEFAULT_RETENTION_DAYS))
+    return datetime.utcnow() - timedelta(days=days)
+
+
+def compact_webhook_events(cutoff: datetime) -> int:
+    """Archive the content of the webhook events received before the cutoff. Returns the number of archived events."""
+    from morocco.application import db
+    from morocco.models import DbWebhookEvent
+
+    count = 0
+    while True:
+        events = DbWebhookEvent.query.filter(DbWebhookEvent.time < cutoff) \
+            .filter(DbWebhookEvent.content.isnot(None)) \
+            .order_by(DbWebhookEvent.id) \
+            .limit(_BATCH_SIZE) \
+            .all()
+        if not events:
+            break
+
+        blob_name = 'webhook-events/{}-{}.jsonl.gz'.format(events[0].id, events[-1].id)
+        _upload_archive(blob_name, [{'id': e.id,
+                                     'event_key': e.event_key,
+                                     'time': e.time.isoformat() if e.time else None,
+                                     'source': e.source,
+                                     'signature': e.signature,
+                                     'content': e.content} for e in events])
+
+        for event in events:
+            event.content = None
+            event.archive = blob_name
+        db.session.commit()
+
+        count += len(events)
+
+    get_logger('retention').info('Archived %d webhook events', count)
+    return count
+
+
+def compact_test_outputs(cutoff: datetime) -> int:
+    """Archive the output of the failed tests of the test runs created before the cutoff."""
+    from morocco.application import db
+    from morocco.models import DbTestCase, DbTestOutput, DbTestRun
+
+    count = 0
+    test_run_ids = [row.test_run_id for row in db.session.query(DbTestCase.test_run_id)
+                    .join(DbTestOutput, DbTestOutput.test_case_id == DbTestCase.id)
+                    .join(DbTestRun, DbTestRun.id == DbTestCase.test_run_id)
+                    .filter(DbTestRun.creation_time < cutoff)
+                    .distinct()]
+    for test_run_id in test_run_ids:
+        outputs = DbTestOutput.query.join(DbTestCase, DbTestOutput.test_case_id == DbTestCase.id) \
+            .filter(DbTestCase.test_run_id == test_run_id) \
+            .all()
+        if not outputs:
+            continue
+
+        blob_name = 'test-outputs/{}-{}.jsonl.gz'.format(test_run_id, datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+        _upload_archive(blob_name, [{'id': o.test_case_id, 'output': o.text} for o in outputs])
+
+        DbTestCase.query.filter(DbTestCase.id.in_([o.test_case_id for o in outputs])) \
+            .update({DbTestCase.output_archive: blob_name}, synchronize_session=False)
+        for output in outputs:
+            db.session.delete(output)
+        db.session.commit()
+
+        count += len(outputs)
+
+    get_logger('retention').info('Archived the output of %d test cases', count)
+    return count
+
+
+def read_archive(blob_name: str) -> Iterator[dict]:
+    from morocco.core.services import get_blob_storage_client
+
+    blob = get_blob_storage_client().get_blob_to_bytes(ARCHIVE_CONTAINER, blob_name)
+    for line in gzip.decompress(blob.content).decode('utf-8').splitlines():
+        yield json.loads(line)
+
+
+def _upload_archive(blob_name: str, records: List[dict]) -> None:
+    from morocco.core.services import get_blob_storage_client
+
+    content = '\n'.join(json.dumps(r) for r in records).encode('utf-8')
+
+    storage = get_blob_storage_client()
+    storage.create_container(ARCHIVE_CONTAINER, fail_on_exist=False)
+    storage.create_blob_from_bytes(ARCHIVE_CONTAINER, blob_name, gzip.compress(content))
@@ -28,8 +28,6 @@ def get_tenant_from_endpoint(endpoint: str) -> str:
 
 
 def should_return_html(request) -> bool:
-    """Poor man's content negotiation"""
-    for each in request.headers.get('Accept').split(','):
-        if each in ('text/html', 'application/xhtml+xml'):
-            return True
-    return False
+    """Poor man's content negotiation, HTML unless JSON is explicitly preferred, e.g. not for */*"""
+    accept = request.accept_mimetypes
+    return accept['application/json'] <= max(accept['text/html'], accept['application/xhtml+xml'])
@@ -1,4 +1,5 @@
-from typing import Iterable
+from typing import Iterable, List
+from .application import db
 from .models import DbBuild, DbTestCase, DbTestRun
 
 
@@ -28,6 +29,35 @@ class Snapshot(ViewModel):
         self._last_live_test_run = None
         self._last_live_test_run_attempted = False
 
+    @staticmethod
+    def load(builds: Iterable[DbBuild]) -> List['Snapshot']:
+        """
+        Wrap the builds in snapshots and load the last live test run of all of them in one query, so a list of
+        snapshots doesn't issue a query per build.
+        """
+        from sqlalchemy import func
+
+        snapshots = [Snapshot(b) for b in builds]
+        if not snapshots:
+            return snapshots
+
+        ranked_runs = db.session.query(
+            DbTestRun.id.label('id'),
+            func.row_number().over(partition_by=DbTestRun.build_id,
+                                   order_by=DbTestRun.creation_time.desc()).label('rank')) \
+            .filter(DbTestRun.build_id.in_([s.data.id for s in snapshots])) \
+            .filter(DbTestRun.live.is_(True)) \
+            .subquery()
+
+        query = DbTestRun.query.join(ranked_runs, ranked_runs.c.id == DbTestRun.id).filter(ranked_runs.c.rank == 1)
+        last_live_test_runs = {r.build_id: r for r in query}
+
+        for snapshot in snapshots:
+            snapshot._last_live_test_run = last_live_test_runs.get(snapshot.data.id)
+            snapshot._last_live_test_run_attempted = True
+
+        return snapshots
+
     @property
     def commit_sha(self):
         return self.data.id
@@ -63,9 +93,7 @@ class Snapshot(ViewModel):
         if not self.last_live_test_run:
             return []
 
-        failed_test_cases = DbTestCase.query.filter_by(test_run_id=self.last_live_test_run.id).filter_by(
-            passed=False).all()
-        return (TestCase(t) for t in failed_test_cases)
+        return (TestCase(t) for t in self.last_live_test_run.get_failed_test_cases())
 
     @property
     def test_runs(self) -> Iterable[TestRun]:
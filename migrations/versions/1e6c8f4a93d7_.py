@@ -0,0 +1,28 @@
+"""archive pointers of webhook events and test outputs
+
+Revision ID: 1e6c8f4a93d7
+Revises: f0b3e95c27a8
+Create Date: 2026-10-16 15:21:08.157734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1e6c8f4a93d7'
+down_revision = 'f0b3e95c27a8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('db_webhook_event', sa.Column('archive', sa.String(), nullable=True))
+    op.create_index(op.f('ix_db_webhook_event_time'), 'db_webhook_event', ['time'], unique=False)
+    op.add_column('db_test_case', sa.Column('output_archive', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('db_test_case', 'output_archive')
+    op.drop_index(op.f('ix_db_webhook_event_time'), table_name='db_webhook_event')
+    op.drop_column('db_webhook_event', 'archive')
@@ -0,0 +1,29 @@
+"""outcome history of the tests
+
+Revision ID: 2c8b5f0e4d39
+Revises: 6f1a9c3d2e87
+Create Date: 2026-10-16 23:52:20.417735
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c8b5f0e4d39'
+down_revision = '6f1a9c3d2e87'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('db_test_history',
+    sa.Column('test_full_name', sa.String(), nullable=False),
+    sa.Column('outcomes', sa.String(), nullable=True),
+    sa.Column('last_test_run_id', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('test_full_name')
+    )
+
+
+def downgrade():
+    op.drop_table('db_test_history')
@@ -0,0 +1,48 @@
+"""attempt of the test cases
+
+Revision ID: 3b9e7a1d5c26
+Revises: 8a3d6e2b5f14
+Create Date: 2026-10-17 09:21:37.284615
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9e7a1d5c26'
+down_revision = '8a3d6e2b5f14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('db_test_case', sa.Column('attempt', sa.Integer(), server_default='0', nullable=False))
+
+    # the retries were told apart by their task id only, <task id>-retry-<attempt>
+    op.execute("UPDATE db_test_case SET attempt = CAST(substring(id from '-retry-([0-9]+)$') AS INTEGER) "
+               "WHERE id ~ '-retry-[0-9]+$'")
+
+    # count the final attempt of every test once, the counters counted every attempt
+    test_run = sa.table('db_test_run', sa.column('id'), sa.column('total_tests'), sa.column('passed_tests'),
+                        sa.column('failed_tests'))
+    test_case = sa.table('db_test_case', sa.column('test_run_id'), sa.column('test_full_name'), sa.column('passed'),
+                         sa.column('attempt'))
+    retry = test_case.alias('retry')
+    retried = sa.select([retry.c.attempt]).where(sa.and_(retry.c.test_run_id == test_case.c.test_run_id,
+                                                         retry.c.test_full_name == test_case.c.test_full_name,
+                                                         retry.c.attempt > test_case.c.attempt))
+
+    def _count(*criteria):
+        return sa.select([sa.func.count()]) \
+            .where(sa.and_(test_case.c.test_run_id == test_run.c.id, ~retried.exists(), *criteria)) \
+            .as_scalar()
+
+    op.execute(test_run.update().values(
+        total_tests=_count(),
+        passed_tests=_count(test_case.c.passed == sa.true()),
+        failed_tests=_count(sa.or_(test_case.c.passed == sa.false(), test_case.c.passed.is_(None)))))
+
+
+def downgrade():
+    op.drop_column('db_test_case', 'attempt')
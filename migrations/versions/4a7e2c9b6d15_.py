@@ -0,0 +1,24 @@
+"""high-water mark of the ingested tasks of a test run
+
+Revision ID: 4a7e2c9b6d15
+Revises: 9d4f27b5e1c0
+Create Date: 2026-10-16 22:48:12.530417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4a7e2c9b6d15'
+down_revision = '9d4f27b5e1c0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('db_test_run', sa.Column('last_task_end_time', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('db_test_run', 'last_task_end_time')
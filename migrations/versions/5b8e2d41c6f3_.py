@@ -0,0 +1,29 @@
+"""indexes for keyset pagination of builds and test runs
+
+Revision ID: 5b8e2d41c6f3
+Revises: a3f1c7d92b40
+Create Date: 2026-10-16 10:03:17.284516
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b8e2d41c6f3'
+down_revision = 'a3f1c7d92b40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_db_build_commit_date_id', 'db_build', ['commit_date', 'id'], unique=False)
+    op.create_index('ix_db_test_run_creation_time_id', 'db_test_run', ['creation_time', 'id'], unique=False)
+    op.create_index('ix_db_test_run_build_id_live_creation_time', 'db_test_run', ['build_id', 'live', 'creation_time'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_db_test_run_build_id_live_creation_time', table_name='db_test_run')
+    op.drop_index('ix_db_test_run_creation_time_id', table_name='db_test_run')
+    op.drop_index('ix_db_build_commit_date_id', table_name='db_build')
@@ -0,0 +1,24 @@
+"""selected modules of the test runs
+
+Revision ID: 6f1a9c3d2e87
+Revises: b85d3e1f7a64
+Create Date: 2026-10-16 23:31:54.096318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f1a9c3d2e87'
+down_revision = 'b85d3e1f7a64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('db_test_run', sa.Column('selection', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('db_test_run', 'selection')
@@ -0,0 +1,40 @@
+"""test durations by build
+
+Revision ID: 7c2d4e9f1a58
+Revises: 3b9e7a1d5c26
+Create Date: 2026-10-17 09:47:12.905316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2d4e9f1a58'
+down_revision = '3b9e7a1d5c26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('db_build_test_duration',
+    sa.Column('build_id', sa.String(), nullable=False),
+    sa.Column('test_full_name', sa.String(), nullable=False),
+    sa.Column('module', sa.String(), nullable=True),
+    sa.Column('total_duration', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('runs', sa.Integer(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('build_id', 'test_full_name')
+    )
+
+    # backfill the durations from the passed test cases of the existing test runs
+    op.execute('INSERT INTO db_build_test_duration (build_id, test_full_name, module, total_duration, runs) '
+               'SELECT db_test_run.build_id, db_test_case.test_full_name, max(db_test_case.module), '
+               'sum(db_test_case.test_duration), count(*) '
+               'FROM db_test_case JOIN db_test_run ON db_test_run.id = db_test_case.test_run_id '
+               'WHERE db_test_case.passed AND db_test_case.test_duration IS NOT NULL '
+               'AND db_test_run.build_id IS NOT NULL '
+               'GROUP BY db_test_run.build_id, db_test_case.test_full_name')
+
+
+def downgrade():
+    op.drop_table('db_build_test_duration')
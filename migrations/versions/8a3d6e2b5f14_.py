@@ -0,0 +1,30 @@
+"""duration statistics of the tests
+
+Revision ID: 8a3d6e2b5f14
+Revises: 2c8b5f0e4d39
+Create Date: 2026-10-17 00:08:43.652190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a3d6e2b5f14'
+down_revision = '2c8b5f0e4d39'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('db_test_duration',
+    sa.Column('test_full_name', sa.String(), nullable=False),
+    sa.Column('durations', sa.String(), nullable=True),
+    sa.Column('p50', sa.Integer(), nullable=True),
+    sa.Column('p95', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('test_full_name')
+    )
+
+
+def downgrade():
+    op.drop_table('db_test_duration')
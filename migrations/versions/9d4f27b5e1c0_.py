@@ -0,0 +1,59 @@
+"""compressed test outputs out of the test case rows
+
+Revision ID: 9d4f27b5e1c0
+Revises: 1e6c8f4a93d7
+Create Date: 2026-10-16 16:37:45.208913
+
+"""
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4f27b5e1c0'
+down_revision = '1e6c8f4a93d7'
+branch_labels = None
+depends_on = None
+
+test_case = sa.table('db_test_case', sa.column('id'), sa.column('output'))
+test_output = sa.table('db_test_output', sa.column('test_case_id'), sa.column('content'))
+
+
+def _copy(rows, table, convert):
+    connection = op.get_bind()
+    batch = []
+    for row in rows:
+        batch.append(convert(row))
+        if len(batch) == 500:
+            connection.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        connection.execute(table.insert(), batch)
+
+
+def upgrade():
+    op.create_table('db_test_output',
+    sa.Column('test_case_id', sa.String(), nullable=False),
+    sa.Column('content', sa.LargeBinary(), nullable=True),
+    sa.ForeignKeyConstraint(['test_case_id'], ['db_test_case.id'], ),
+    sa.PrimaryKeyConstraint('test_case_id')
+    )
+
+    rows = op.get_bind().execution_options(stream_results=True).execute(
+        sa.select([test_case.c.id, test_case.c.output]).where(test_case.c.output.isnot(None)))
+    _copy(rows, test_output, lambda r: {'test_case_id': r.id, 'content': zlib.compress(r.output.encode('utf-8'))})
+
+    op.drop_column('db_test_case', 'output')
+
+
+def downgrade():
+    op.add_column('db_test_case', sa.Column('output', sa.VARCHAR(), autoincrement=False, nullable=True))
+
+    connection = op.get_bind()
+    for row in connection.execute(sa.select([test_output.c.test_case_id, test_output.c.content])):
+        connection.execute(test_case.update().where(test_case.c.id == row.test_case_id)
+                           .values(output=zlib.decompress(row.content).decode('utf-8')))
+
+    op.drop_table('db_test_output')
@@ -0,0 +1,47 @@
+"""aggregated test results on test run
+
+Revision ID: a3f1c7d92b40
+Revises: 7007b8960739
+Create Date: 2026-10-16 09:12:41.503217
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f1c7d92b40'
+down_revision = '7007b8960739'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('db_test_run', sa.Column('total_tests', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('db_test_run', sa.Column('passed_tests', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('db_test_run', sa.Column('failed_tests', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('db_test_run', sa.Column('total_duration', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill the counters from the existing test cases
+    test_run = sa.table('db_test_run', sa.column('id'), sa.column('total_tests'), sa.column('passed_tests'),
+                        sa.column('failed_tests'), sa.column('total_duration'))
+    test_case = sa.table('db_test_case', sa.column('test_run_id'), sa.column('passed'), sa.column('test_duration'))
+
+    def _aggregate(expression, *criteria):
+        return sa.select([sa.func.coalesce(expression, 0)]) \
+            .where(sa.and_(test_case.c.test_run_id == test_run.c.id, *criteria)) \
+            .as_scalar()
+
+    op.execute(test_run.update().values(
+        total_tests=_aggregate(sa.func.count()),
+        passed_tests=_aggregate(sa.func.count(), test_case.c.passed == sa.true()),
+        failed_tests=_aggregate(sa.func.count(), sa.or_(test_case.c.passed == sa.false(),
+                                                        test_case.c.passed.is_(None))),
+        total_duration=_aggregate(sa.func.sum(test_case.c.test_duration))))
+
+
+def downgrade():
+    op.drop_column('db_test_run', 'total_duration')
+    op.drop_column('db_test_run', 'failed_tests')
+    op.drop_column('db_test_run', 'passed_tests')
+    op.drop_column('db_test_run', 'total_tests')
@@ -0,0 +1,26 @@
+"""source tree hash of the builds
+
+Revision ID: b85d3e1f7a64
+Revises: 4a7e2c9b6d15
+Create Date: 2026-10-16 23:02:37.814206
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b85d3e1f7a64'
+down_revision = '4a7e2c9b6d15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('db_build', sa.Column('tree_sha', sa.String(), nullable=True))
+    op.create_index(op.f('ix_db_build_tree_sha'), 'db_build', ['tree_sha'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_db_build_tree_sha'), table_name='db_build')
+    op.drop_column('db_build', 'tree_sha')
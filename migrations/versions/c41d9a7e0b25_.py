@@ -0,0 +1,39 @@
+"""background job queue
+
+Revision ID: c41d9a7e0b25
+Revises: 5b8e2d41c6f3
+Create Date: 2026-10-16 11:26:54.918302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41d9a7e0b25'
+down_revision = '5b8e2d41c6f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('db_background_job',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(), nullable=True),
+    sa.Column('payload', sa.String(), nullable=True),
+    sa.Column('state', sa.String(), nullable=True),
+    sa.Column('progress', sa.Integer(), nullable=True),
+    sa.Column('total', sa.Integer(), nullable=True),
+    sa.Column('message', sa.String(), nullable=True),
+    sa.Column('worker', sa.String(), nullable=True),
+    sa.Column('creation_time', sa.DateTime(), nullable=True),
+    sa.Column('start_time', sa.DateTime(), nullable=True),
+    sa.Column('end_time', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_db_background_job_state'), 'db_background_job', ['state'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_db_background_job_state'), table_name='db_background_job')
+    op.drop_table('db_background_job')
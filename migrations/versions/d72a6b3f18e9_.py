@@ -0,0 +1,32 @@
+"""http cache for github api requests
+
+Revision ID: d72a6b3f18e9
+Revises: c41d9a7e0b25
+Create Date: 2026-10-16 12:48:06.371945
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd72a6b3f18e9'
+down_revision = 'c41d9a7e0b25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('db_http_cache',
+    sa.Column('url', sa.String(), nullable=False),
+    sa.Column('etag', sa.String(), nullable=True),
+    sa.Column('last_modified', sa.String(), nullable=True),
+    sa.Column('next_url', sa.String(), nullable=True),
+    sa.Column('content', sa.String(), nullable=True),
+    sa.Column('time', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('url')
+    )
+
+
+def downgrade():
+    op.drop_table('db_http_cache')
@@ -0,0 +1,26 @@
+"""lease of the background jobs
+
+Revision ID: e5a8c2f7b913
+Revises: 7c2d4e9f1a58
+Create Date: 2026-10-17 10:12:54.631870
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a8c2f7b913'
+down_revision = '7c2d4e9f1a58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('db_background_job', sa.Column('heartbeat_time', sa.DateTime(), nullable=True))
+    # the jobs running now renewed their lease when they started
+    op.execute("UPDATE db_background_job SET heartbeat_time = start_time WHERE state = 'running'")
+
+
+def downgrade():
+    op.drop_column('db_background_job', 'heartbeat_time')
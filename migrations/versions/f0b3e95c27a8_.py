@@ -0,0 +1,26 @@
+"""key of webhook events from the write-behind log
+
+Revision ID: f0b3e95c27a8
+Revises: d72a6b3f18e9
+Create Date: 2026-10-16 14:05:39.662180
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f0b3e95c27a8'
+down_revision = 'd72a6b3f18e9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('db_webhook_event', sa.Column('event_key', sa.String(), nullable=True))
+    op.create_index(op.f('ix_db_webhook_event_event_key'), 'db_webhook_event', ['event_key'], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_db_webhook_event_event_key'), table_name='db_webhook_event')
+    op.drop_column('db_webhook_event', 'event_key')